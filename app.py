@@ -1,30 +1,303 @@
-import os
-from flask import Flask, request, jsonify, abort
+import click
+import math
+from flask import Flask, Response, current_app, g, request, jsonify, abort, stream_with_context
 from models import setup_db
 from flask_cors import CORS
-from auth import AuthError, requires_auth
-from models import db_drop_and_create_all, setup_db, Movie, Actor
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.middleware.proxy_fix import ProxyFix
+from config import load_config
+from auth import AuthError, requires_auth, key_set
+from health import ReadinessProbe
+from compression import PrecompressedBody, init_compression
+from ratelimit import init_rate_limits
+from profiling import init_profiling, profiler
+from changes import init_change_feed, poll_changes, stream_changes
+from validation import ValidationError, init_validation, validate_movie, validate_movie_patch, validate_actor, validate_actor_patch, validate_casting
+from replicas import read_only, replica_engine
+from models import db_drop_and_create_all, setup_db, db, Movie, Actor, castings, movie_documents, read_model_revision, rebuild_read_model, create_missing_tables, migrate_castings, prune_changes
+from singleflight import SingleFlight
+from snapshot import write_snapshot
+from sqlalchemy import event, select
 from sqlalchemy.exc import SQLAlchemyError
 
+'''
+Concurrent identical list queries share one in-flight execution
+every commit in this process starts new flights, so a client never joins a
+query that began before its own write
+'''
+list_queries = SingleFlight()
+
+def list_key(name):
+    engine = replica_engine()
+    return (name, str(engine.url) if engine is not None else None)
+
+def forget_list_queries(session):
+    list_queries.forget_all()
+
+'''
+shared_list(name, fn)
+    runs fn as the flight for the named list on this request's database
+    a follower receives the leader's error; when that error came from the
+    replica they share, the follower is flagged like the leader, so @read_only
+    replays it on the primary as well
+'''
+def shared_list(name, fn):
+    try:
+        return list_queries.do(list_key(name), fn)
+    except SQLAlchemyError:
+        if replica_engine() is not None:
+            g.replica_failed = True
+        raise
+
+'''
+GET /movies body per app and database target, labelled with the read model
+revision it was joined from; it is rebuilt only when the revision moves, and
+stored as a PrecompressedBody (built with the app's COMPRESS_* settings) so
+each encoding is compressed once per rebuild
+'''
+def movies_body():
+    movie_lists = current_app.extensions.setdefault('movie_lists', {})
+    key = list_key('movies')
+    revision = read_model_revision()
+    cached = movie_lists.get(key)
+    if cached is not None and cached[0] == revision:
+        return cached[1]
+
+    documents = movie_documents()
+    body = None
+    if documents:
+        body = PrecompressedBody(
+            '{"movies":[' + ','.join(documents) + '],"success":true}\n',
+            min_size=current_app.config.get('COMPRESS_MIN_SIZE', 1024),
+            level=current_app.config.get('COMPRESS_LEVEL', 6))
+    movie_lists[key] = (revision, body)
+    return body
+
+'''
+readiness_probe()
+    the app's ReadinessProbe, built on the first /health/ready request
+'''
+def readiness_probe():
+    probe = current_app.extensions.get('readiness')
+    if probe is None:
+        config = current_app.config
+        probe = current_app.extensions.setdefault('readiness', ReadinessProbe(
+            db.get_engine(current_app),
+            key_set(),
+            cache_seconds=config.get('HEALTH_CACHE_SECONDS', 2.0),
+            timeout=config.get('HEALTH_TIMEOUT', 1.0),
+            max_saturation=config.get('HEALTH_MAX_POOL_SATURATION', 0.9),
+            max_overflow=config.get('SQLALCHEMY_ENGINE_OPTIONS', {}).get('max_overflow', 10)))
+    return probe
+
+'''
+Columns a bulk request may filter on and change, per model
+'''
+BULK_FIELDS = {
+    Movie: ('title', 'release_date'),
+    Actor: ('name', 'age', 'gender', 'movie_id'),
+}
+
+INT_MIN, INT_MAX = -2**31, 2**31 - 1
+
+BULK_VALIDATORS = {
+    Movie: validate_movie_patch,
+    Actor: validate_actor_patch,
+}
+
+'''
+bulk_criteria(model, body)
+    builds the WHERE criteria of a bulk request from an id list
+    (?ids=1,2,3 or "ids" in the body) and column filters such as ?movie_id=1
+    aborts 400 when nothing selects the rows, so a bare PATCH/DELETE can never
+    touch the whole table; body ids must be a list of JSON integers, so a
+    string, float or boolean never selects a row it does not name
+'''
+def bulk_criteria(model, body):
+    criteria = []
+    if not isinstance(body, dict):
+        abort(400)
+
+    ids = body.get('ids')
+    if ids is not None:
+        # bool is an int subclass, but true is not an id
+        if not isinstance(ids, list) or not all(type(i) is int for i in ids):
+            abort(400)
+    elif 'ids' in request.args:
+        try:
+            ids = [int(i) for i in request.args['ids'].split(',')]
+        except ValueError:
+            abort(400)
+    if ids is not None:
+        if not all(INT_MIN <= i <= INT_MAX for i in ids):
+            abort(400)
+        criteria.append(model.id.in_(ids))
+
+    for field in BULK_FIELDS[model]:
+        if field not in request.args:
+            continue
+        column = getattr(model, field)
+        try:
+            value = column.type.python_type(request.args[field])
+        except (TypeError, ValueError, NotImplementedError):
+            abort(400)
+        # a value the column cannot hold would fail in the database instead
+        if isinstance(value, int) and not INT_MIN <= value <= INT_MAX:
+            abort(400)
+        criteria.append(column == value)
+
+    if not criteria:
+        abort(400)
+    return criteria
+
+def bulk_update(model):
+    body = request.get_json(silent=True) or {}
+    criteria = bulk_criteria(model, body)
+
+    values = BULK_VALIDATORS[model](body)
+    if not values:
+        abort(400)
+
+    try:
+        ids = model.bulk_update(criteria, values)
+    except SQLAlchemyError:
+        abort(422)
+    if not ids:
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        'updated': len(ids),
+        'ids': ids
+    })
+
+def bulk_delete(model):
+    body = request.get_json(silent=True) or {}
+    criteria = bulk_criteria(model, body)
+
+    try:
+        ids = model.bulk_delete(criteria)
+    except SQLAlchemyError:
+        abort(422)
+    if not ids:
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        'deleted': len(ids),
+        'ids': ids
+    })
+
+'''
+create_app(test_config)
+    builds the app from load_config() overridden by test_config
+    it connects to nothing: engines, replicas and the JWKS key set are
+    created on first use, so importing this module or preloading it in a
+    gunicorn master is cheap and fork safe
+    it never seeds the tables either: `flask init-db` drops, recreates and
+    seeds them, once, as a deploy step
+'''
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    app.config.from_mapping(load_config())
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
+    # behind a load balancer remote_addr is the balancer; trust exactly as
+    # many X-Forwarded-* hops as there are proxies, so clients cannot spoof it
+    hops = app.config.get('PROXY_FIX_HOPS', 0)
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
+    init_profiling(app)
+    init_rate_limits(app)
     setup_db(app)
     CORS(app)
+    init_compression(app)
+    init_change_feed(app)
+    init_validation(app)
+    if not event.contains(db.session, 'after_commit', forget_list_queries):
+        event.listen(db.session, 'after_commit', forget_list_queries)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Drops, recreates and seeds the database tables."""
+        db_drop_and_create_all()
+
+    @app.cli.command('rebuild-read-model')
+    def rebuild_read_model_command():
+        """Re-renders every movie document of the GET /movies read model."""
+        create_missing_tables()
+        rebuild_read_model()
+
+    @app.cli.command('migrate-castings')
+    def migrate_castings_command():
+        """Creates the missing tables, folds actors.movie_id into castings and rebuilds the read model."""
+        migrate_castings()
+        rebuild_read_model()
+
+    @app.cli.command('export-snapshot')
+    @click.argument('path')
+    def export_snapshot_command(path):
+        """Writes the actors and movies tables to a columnar snapshot file."""
+        write_snapshot(path, {
+            'actors': db.session.execute(
+                select(Actor.__table__).order_by(Actor.id)).mappings(),
+            'movies': db.session.execute(
+                select(Movie.__table__).order_by(Movie.id)).mappings(),
+        })
 
-    db_drop_and_create_all()
+    @app.cli.command('prune-changes')
+    @click.argument('days', type=float)
+    def prune_changes_command(days):
+        """Deletes change feed entries older than DAYS days."""
+        click.echo(f'Deleted {prune_changes(days)} changes.')
 
     @app.route('/')
     def get_greeting():
-        excited = os.environ['EXCITED']
         greeting = "Hello" 
-        if excited == 'true': 
+        if app.config['EXCITED']: 
             greeting = greeting + "!!!!! You are doing great in this Udacity project."
         return greeting
 
     @app.route('/health')
     def be_cool():
         return "Health!! OK"
+
+    '''
+    GET /health/live
+    - Liveness: the worker is up and serving requests; checks nothing else
+    GET /health/ready
+    - Readiness: database checkout, connection pool saturation and JWKS
+      freshness, cached for HEALTH_CACHE_SECONDS
+    - Returns 200 when every check passes and 503 otherwise
+    Response:
+        {
+            "success": true,
+            "ready": true,
+            "checks": {
+                "database": {"ok": true, "ms": 1.2},
+                "pool": {"ok": true, "checked_out": 1, "capacity": 15, "saturation": 0.07},
+                "jwks": {"ok": true, "age": 42.0}
+            }
+        }
+    '''
+    @app.route('/health/live')
+    def health_live():
+        return jsonify({
+            'success': True,
+            'status': 'alive'
+        })
+
+    @app.route('/health/ready')
+    def health_ready():
+        ready, checks = readiness_probe().check()
+        return jsonify({
+            'success': ready,
+            'ready': ready,
+            'checks': checks
+        }), 200 if ready else 503
     
     '''
     GET /movies
@@ -53,19 +326,23 @@ def create_app(test_config=None):
     
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @read_only
     def get_movies(payload):
         try:
-            select_movies = Movie.query.order_by(Movie.id).all()   
-            format_movies = [movies.format() for movies in select_movies]
-            print("Select movies:",select_movies)
-            print("format movies:",format_movies)
-            if len(select_movies) ==0:
+            # pre-rendered documents from the movie read model
+            body = shared_list('movies', movies_body)
+            if body is None:
                 abort(404)
             else:    
-                return jsonify({
-                'success':True,
-                'movies':format_movies
-            })
+                if not app.config.get('COMPRESS_ENABLED', True):
+                    return app.response_class(body.data, mimetype='application/json')
+                data, encoding = body.encode(request.headers.get('Accept-Encoding'))
+                response = app.response_class(data, mimetype='application/json')
+                # the body depends on Accept-Encoding even when it goes out plain
+                response.vary.add('Accept-Encoding')
+                if encoding is not None:
+                    response.headers['Content-Encoding'] = encoding
+                return response
         except Exception as e:
             print("get movies exception",e)
 
@@ -99,12 +376,13 @@ def create_app(test_config=None):
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @read_only
     def get_actors(payload):
         try:
-            select_actors = Actor.query.order_by(Actor.id).all()   
-            format_actors = [actors.format() for actors in select_actors]
+            format_actors = shared_list('actors', lambda: [
+                actors.format() for actors in Actor.query.order_by(Actor.id).all()])
 
-            if len(select_actors) ==0:
+            if len(format_actors) ==0:
                 abort(404)
             else:    
                 return jsonify({
@@ -114,6 +392,142 @@ def create_app(test_config=None):
         except Exception as e:
             print("get actors exception",e)
 
+    '''
+    GET /movies/<int:id>/actors
+    - Fetches the cast of a movie with one indexed join over castings
+    - Request arguments: Movie id
+    - Returns: the movie id and its actors, 404 if the movie does not exist
+    Response:
+        {
+            "success": true,
+            "movie_id": 1,
+            "actors":
+            [
+                {
+                    "id": 1,
+                    "name": "John",
+                    "age": 35,
+                    "gender": "Male",
+                    "movie_id": 1
+                }
+            ]
+        }
+    '''
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    @read_only
+    def get_movie_actors(payload, movie_id):
+        # outer joins from movies: one row with no actor means an empty cast,
+        # no row at all means no such movie
+        rows = (db.session.query(Movie.id, Actor)
+                .outerjoin(castings, castings.c.movie_id == Movie.id)
+                .outerjoin(Actor, Actor.id == castings.c.actor_id)
+                .filter(Movie.id == movie_id)
+                .order_by(Actor.id)
+                .all())
+        if not rows:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+            'actors': [actor.format() for _, actor in rows if actor is not None]
+        })
+
+    '''
+    GET /actors/<int:id>/movies
+    - Fetches the movies an actor is cast in with one indexed join over
+      castings
+    - Request arguments: Actor id
+    - Returns: the actor id and its movies (without their casts), 404 if the
+      actor does not exist
+    Response:
+        {
+            "success": true,
+            "actor_id": 1,
+            "movies":
+            [
+                {
+                    "id": 1,
+                    "title": "Movie1",
+                    "release_date": "June"
+                }
+            ]
+        }
+    '''
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:movies')
+    @read_only
+    def get_actor_movies(payload, actor_id):
+        rows = (db.session.query(Actor.id, Movie)
+                .outerjoin(castings, castings.c.actor_id == Actor.id)
+                .outerjoin(Movie, Movie.id == castings.c.movie_id)
+                .filter(Actor.id == actor_id)
+                .order_by(Movie.id)
+                .all())
+        if not rows:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actor_id': actor_id,
+            'movies': [movie.format(actors=False) for _, movie in rows if movie is not None]
+        })
+
+    '''
+    POST /movies/<int:id>/actors
+    - Casts an existing actor in a movie
+    - Request arguments: Movie id
+    - Returns: the movie with its cast
+    Body:
+        {
+            "actor_id": 2
+        }
+    DELETE /movies/<int:id>/actors/<int:actor_id>
+    - Removes an actor from a movie's cast
+    - Returns: the movie with its cast
+    '''
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth('patch:movies')
+    def cast_actor(payload, movie_id):
+        values = validate_casting(request.get_json(silent=True) or {})
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        actor = Actor.query.filter(Actor.id == values['actor_id']).one_or_none()
+        if movie is None or actor is None:
+            abort(404)
+
+        # compare ids: the @dataclass models all compare equal to each other
+        if not any(cast.id == actor.id for cast in movie.actors):
+            movie.actors.append(actor)
+            movie.update()
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format()
+        })
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def uncast_actor(payload, movie_id, actor_id):
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        if movie is None:
+            abort(404)
+        position = next((i for i, actor in enumerate(movie.actors) if actor.id == actor_id), None)
+        if position is None:
+            abort(404)
+
+        # the legacy movie_id must not keep pointing at a movie the actor left
+        actor = movie.actors[position]
+        if actor.movie_id == movie_id:
+            actor.movie_id = None
+        del movie.actors[position]
+        movie.update()
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format()
+        })
+
     '''
     POST /movies
     - Creates a movie from the request's body
@@ -145,14 +559,10 @@ def create_app(test_config=None):
         if body is None:
             abort(400)
 
-        new_title = body.get('title', None)
-        new_release_date = body.get('release_date', None)
-
-        if new_title is None or new_release_date is None:
-            abort(400, "Missing field for Movie")
+        values = validate_movie(body)
 
-        movie = Movie(title=new_title,
-                      release_date=new_release_date)
+        movie = Movie(title=values['title'],
+                      release_date=values['release_date'])
 
         movie.insert()
 
@@ -196,15 +606,9 @@ def create_app(test_config=None):
         if body is None:
             abort(400)
 
-        new_name = body.get('name', None)
-        new_age = body.get('age', None)
-        new_gender = body.get('gender', None)
-        new_movie_id = body.get('movie_id', None)
-
-        if new_name is None or new_age is None or new_gender is None or new_movie_id is None:
-            abort(400)
+        values = validate_actor(body)
 
-        actor = Actor(name=new_name, age=new_age, gender=new_gender, movie_id=new_movie_id)
+        actor = Actor(**values)
 
         actor.insert()
 
@@ -243,17 +647,18 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def update_actor(payload, actor_id):
+        values = validate_actor_patch(request.get_json(silent=True))
+
         # Query for the actor by ID
         actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
         
         if actor is None:
             abort(404)  # Actor not found
 
-        body = request.get_json()
-        new_name = body.get('name')
-        new_age = body.get('age')
-        new_gender = body.get('gender')
-        new_movie = body.get('movie_id')
+        new_name = values.get('name')
+        new_age = values.get('age')
+        new_gender = values.get('gender')
+        new_movie = values.get('movie_id')
 
         # Update only if new values are provided
         if new_name is not None:
@@ -301,6 +706,8 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(payload, movie_id):
+        values = validate_movie_patch(request.get_json(silent=True))
+
         # Query for the movie by ID
         movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
         
@@ -308,9 +715,8 @@ def create_app(test_config=None):
             abort(404)  # Movie not found
         
 
-        body = request.get_json()
-        new_title = body.get('title', None)
-        new_release_date = body.get('release_date', None)
+        new_title = values.get('title')
+        new_release_date = values.get('release_date')
 
         if new_title is None or new_release_date is None:
             abort(422, "Title or release date are required.")  # Return a 422 error if required fields are missing
@@ -396,6 +802,165 @@ def create_app(test_config=None):
         except SQLAlchemyError:
             abort(422)  
 
+    '''
+    PATCH /actors and PATCH /movies
+    - Updates every actor/movie selected by an id list or a column filter
+      in one UPDATE statement and one transaction
+    - Request arguments: ids=1,2,3 and/or a column filter such as movie_id=1
+      (the id list may also be sent as "ids" in the body)
+    - Returns: the number of updated rows and their ids
+    Body:
+        {
+            "movie_id": 2
+        }
+    Response:
+        {
+            "success": true,
+            "updated": 2,
+            "ids": [1, 3]
+        }
+    '''
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def bulk_update_actors(payload):
+        return bulk_update(Actor)
+
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def bulk_update_movies(payload):
+        return bulk_update(Movie)
+
+    '''
+    DELETE /actors and DELETE /movies
+    - Deletes every actor/movie selected by an id list or a column filter
+      in one DELETE statement and one transaction
+    - Request arguments: ids=1,2,3 and/or a column filter such as movie_id=1
+    - Returns: the number of deleted rows and their ids
+    Response:
+        {
+            "success": true,
+            "deleted": 2,
+            "ids": [1, 3]
+        }
+    '''
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def bulk_delete_actors(payload):
+        return bulk_delete(Actor)
+
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def bulk_delete_movies(payload):
+        return bulk_delete(Movie)
+
+    '''
+    GET /changes
+    - Fetches the movie and actor changes committed after a sequence number,
+      oldest first, so a client can sync incrementally instead of re-reading
+      the lists; actor changes are only included for tokens with get:actors
+    - Request arguments: since (default 0), limit (default 100, at most
+      CHANGES_MAX_LIMIT), wait (seconds to long-poll for the first change,
+      at most CHANGES_MAX_WAIT)
+    - With Accept: text/event-stream the changes are streamed as server-sent
+      events instead, resuming from Last-Event-ID on reconnect
+    - Streams and waiting long-polls each hold a request thread; past
+      CHANGES_MAX_WAITERS of them the worker answers 503 with Retry-After
+    - Returns: the changes and the seq to pass as since on the next call;
+      data is the movie (with its cast) or actor as GET returns it, null
+      for a delete
+    Response:
+        {
+            "success": true,
+            "changes": [
+                {
+                    "seq": 42,
+                    "entity": "actor",
+                    "id": 3,
+                    "op": "upsert",
+                    "data": {"id": 3, "name": "Julia", "age": 34, "gender": "Women", "movie_id": 1}
+                }
+            ],
+            "last_seq": 42
+        }
+    '''
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_changes(payload):
+        since = request.args.get('since', 0, type=int)
+        limit = min(request.args.get('limit', 100, type=int), app.config['CHANGES_MAX_LIMIT'])
+        if limit < 1:
+            abort(400)
+        entities = ['movie']
+        if 'get:actors' in payload.get('permissions', []):
+            entities.append('actor')
+
+        feed = app.extensions['changes']
+        if request.accept_mimetypes.best == 'text/event-stream':
+            since = request.headers.get('Last-Event-ID', since, type=int)
+            if not feed.hold():
+                raise ServiceUnavailable('Too many open change streams.',
+                                         retry_after=math.ceil(app.config['CHANGES_MAX_WAIT']))
+            response = Response(
+                stream_with_context(stream_changes(
+                    since, limit, entities,
+                    duration=app.config['CHANGES_STREAM_SECONDS'],
+                    heartbeat=app.config['CHANGES_HEARTBEAT_SECONDS'])),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            # runs however the stream ends, even if it never started
+            response.call_on_close(feed.release)
+            return response
+
+        wait = request.args.get('wait', 0, type=float)
+        # nan passes any clamp and would never reach the poll's deadline
+        if not math.isfinite(wait):
+            abort(400)
+        wait = min(max(wait, 0), app.config['CHANGES_MAX_WAIT'])
+        if wait and not feed.hold():
+            raise ServiceUnavailable('Too many waiting change polls.',
+                                     retry_after=math.ceil(app.config['CHANGES_MAX_WAIT']))
+        try:
+            changes = poll_changes(since, limit, entities, wait)
+        finally:
+            if wait:
+                feed.release()
+        return jsonify({
+            'success': True,
+            'changes': changes,
+            'last_seq': changes[-1]['seq'] if changes else since
+        })
+
+    '''
+    GET /admin/profile
+    - Fetches the stacks sampled from profiled requests (see PROFILE_* in
+      config.py), aggregated per route; 404 when profiling is off
+    - Request arguments: format (collapsed, the default, or json), reset
+      (true clears the samples after reading them)
+    - Returns: one "route;outer;...;inner count" line per distinct stack,
+      ready for flamegraph.pl or speedscope
+    Response:
+        GET /movies;app.py:get_movies;models.py:movie_documents;... 12
+    '''
+    @app.route('/admin/profile', methods=['GET'])
+    @requires_auth('admin:profile')
+    def get_profile(payload):
+        sampler = profiler()
+        if sampler is None:
+            abort(404)
+        stacks, requests = sampler.stacks(reset=request.args.get('reset') == 'true')
+
+        if request.args.get('format') == 'json':
+            return jsonify({
+                'success': True,
+                'requests': requests,
+                'samples': sum(stacks.values()),
+                'stacks': [{'stack': stack, 'count': count}
+                           for stack, count in sorted(stacks.items(), key=lambda item: -item[1])]
+            })
+        return Response(
+            ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items())),
+            mimetype='text/plain')
+
     # Error Handling
 
     @app.errorhandler(422)
@@ -422,6 +987,37 @@ def create_app(test_config=None):
             "message": 'The request can not be processed'
         }), 400
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": error.description
+        })
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": error.description
+        })
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 503
+
+    @app.errorhandler(ValidationError)
+    def validation_error(error):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": 'The request can not be processed',
+            "errors": error.errors
+        }), 400
+
     @app.errorhandler(AuthError)
     def auth_error(auth_error):
         return jsonify({
@@ -441,7 +1037,16 @@ def create_app(test_config=None):
     return app   
     
 
-app = create_app()
+'''
+The module level `app` (e.g. `gunicorn app:app`) is created on first access,
+so importing this module for create_app(), tests or tooling builds nothing
+'''
+def __getattr__(name):
+    global app
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
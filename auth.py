@@ -1,14 +1,15 @@
-import os
 import json
-from flask import request, _request_ctx_stack
+import time
+from flask import current_app, request, _request_ctx_stack, g
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from ratelimit import check_rate_limit
+from singleflight import SingleFlight
+from sharedcache import shared_store
 
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
-API_AUDIENCE = os.environ['API_AUDIENCE']
 
 ## AuthError Exception
 '''
@@ -88,6 +89,126 @@ def check_permissions(permission, payload):
         }, 403)
     return True
 
+'''
+KeySet
+    the Auth0 key set of one app, fetched on first use and at most once per
+    ttl seconds; concurrent fetches are collapsed into one request to Auth0
+    get(refresh=True) refetches a key set older than min_refresh, for tokens
+    signed with a key we have not seen yet
+    with a store (see sharedcache.py) a fetch is published to the other
+    workers, and a worker takes a fresh enough key set from the store
+    before going to Auth0 itself
+'''
+JWK_FIELDS = ('kid', 'kty', 'use', 'n', 'e')
+
+class KeySet:
+    def __init__(self, url, ttl=600, min_refresh=30, store=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.store = store
+        self._cached = (None, 0.0)
+        self._fetches = SingleFlight()
+
+    def fetch(self, max_age=None):
+        shared = self._shared(max_age if max_age is not None else self.ttl)
+        if shared is not None:
+            return shared
+
+        jsonurl = urlopen(self.url)
+        jwks = json.loads(jsonurl.read())
+        self._cached = (jwks, time.monotonic())
+        if self.store is not None:
+            # only the fields verify_decode_jwt reads, so the set fits a slot
+            keys = [{field: key.get(field) for field in JWK_FIELDS} for key in jwks['keys']]
+            self.store.put('jwks', json.dumps({'keys': keys, 'fetched_at': time.time()}).encode(), self.ttl)
+        return jwks
+
+    def _shared(self, max_age):
+        value = self.store.get('jwks') if self.store is not None else None
+        if value is None:
+            return None
+        shared = json.loads(value)
+        age = max(time.time() - shared.pop('fetched_at'), 0.0)
+        if age > max_age:
+            return None
+        self._cached = (shared, time.monotonic() - age)
+        return shared
+
+    def age(self):
+        '''Seconds since the key set was fetched, or None if it never was.'''
+        jwks, fetched_at = self._cached
+        return None if jwks is None else time.monotonic() - fetched_at
+
+    def get(self, refresh=False):
+        jwks, fetched_at = self._cached
+        age = time.monotonic() - fetched_at
+        if jwks is None or age > self.ttl:
+            jwks = self._fetches.do('jwks', self.fetch)
+        elif refresh and age > self.min_refresh:
+            jwks = self._fetches.do('refresh', lambda: self.fetch(max_age=self.min_refresh))
+        return jwks
+
+
+'''
+TokenCache
+    the payloads of verified tokens, so a token is verified once per ttl
+    seconds (never past its exp) rather than on every request; entries are
+    keyed by a hash of the audience, issuer and token
+'''
+class TokenCache:
+    def __init__(self, store, ttl=300, audience=None, issuer=None):
+        self.store = store
+        self.ttl = ttl
+        self.prefix = f'token:{audience}:{issuer}:'
+
+    def get(self, token):
+        value = self.store.get(self.prefix + token)
+        if value is None:
+            return None
+        payload = json.loads(value)
+        if payload.get('exp', float('inf')) <= time.time():
+            return None
+        return payload
+
+    def put(self, token, payload):
+        ttl = min(self.ttl, payload.get('exp', float('inf')) - time.time())
+        if ttl > 0:
+            self.store.put(self.prefix + token, json.dumps(payload).encode(), ttl)
+
+
+def cache_store():
+    store = current_app.extensions.get('shared_cache')
+    if store is None:
+        store = current_app.extensions.setdefault('shared_cache', shared_store(current_app.config))
+    return store
+
+def token_cache():
+    tokens = current_app.extensions.get('tokens')
+    if tokens is None:
+        config = current_app.config
+        ttl = config.get('TOKEN_CACHE_TTL', 300)
+        tokens = current_app.extensions.setdefault('tokens', ttl and TokenCache(
+            cache_store(), ttl,
+            audience=config.get('API_AUDIENCE'),
+            issuer=config.get('AUTH0_DOMAIN')))
+    return tokens or None
+
+
+def key_set():
+    keys = current_app.extensions.get('jwks')
+    if keys is None:
+        config = current_app.config
+        keys = current_app.extensions.setdefault('jwks', KeySet(
+            config['JWKS_URL'],
+            ttl=config.get('JWKS_CACHE_TTL', 600),
+            min_refresh=config.get('JWKS_MIN_REFRESH', 30),
+            store=cache_store()))
+    return keys
+
+def get_jwks(refresh=False):
+    return key_set().get(refresh)
+
 '''
 @TODO implement verify_decode_jwt(token) method
     @INPUTS
@@ -103,8 +224,7 @@ def check_permissions(permission, payload):
 '''
 def verify_decode_jwt(token):
     # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    jwks = get_jwks()
     
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
@@ -117,6 +237,10 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
+    # the key set may have rotated since we cached it
+    if not any(key['kid'] == unverified_header['kid'] for key in jwks['keys']):
+        jwks = get_jwks(refresh=True)
+
     for key in jwks['keys']:
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
@@ -135,8 +259,8 @@ def verify_decode_jwt(token):
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                audience=current_app.config['API_AUDIENCE'],
+                issuer='https://' + current_app.config['AUTH0_DOMAIN'] + '/'
             )
 
             return payload
@@ -177,8 +301,15 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            tokens = token_cache()
+            payload = tokens.get(token) if tokens is not None else None
+            if payload is None:
+                payload = verify_decode_jwt(token)
+                if tokens is not None:
+                    tokens.put(token, payload)
+            check_rate_limit(payload, permission)
             check_permissions(permission, payload)
+            g.current_user = payload
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,174 @@
+'''
+Measures how GET /movies throughput scales with the number of gunicorn
+workers on this host, using gunicorn.conf.py.
+
+Tokens are signed with a throwaway RSA key whose JWKS is served from a
+file:// URL, so no Auth0 tenant is needed; the database is a seeded SQLite
+file unless DATABASE_URL is set. For each worker count it starts gunicorn,
+warms it up, then drives it with --clients keep-alive connections spread
+over several client processes for --seconds and reports requests per
+second and latency percentiles. --tokens distinct tokens are cycled, so the
+shared token cache is exercised across workers.
+
+    python benchmarks/gunicorn_benchmark.py --workers 1 2 4 8 --seconds 10
+    python benchmarks/gunicorn_benchmark.py --no-shared-cache
+'''
+import argparse
+import base64
+import http.client
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+AUDIENCE = 'benchmark'
+DOMAIN = 'benchmark.invalid'
+
+
+def b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def signing_setup(directory, tokens):
+    key = RSA.generate(2048)
+    jwks_path = os.path.join(directory, 'jwks.json')
+    with open(jwks_path, 'w') as jwks:
+        json.dump({'keys': [{'kid': 'benchmark', 'kty': 'RSA', 'use': 'sig', 'alg': 'RS256',
+                             'n': b64(key.n), 'e': b64(key.e)}]}, jwks)
+    private_key = key.export_key().decode()
+    claims = {'iss': f'https://{DOMAIN}/', 'aud': AUDIENCE, 'exp': int(time.time()) + 3600,
+              'permissions': ['get:movies', 'get:actors']}
+    signed = [jwt.encode(dict(claims, sub=f'client-{i}'), private_key, algorithm='RS256',
+                         headers={'kid': 'benchmark'})
+              for i in range(tokens)]
+    return 'file://' + jwks_path, signed
+
+
+def client(port, tokens, seconds, connections, results):
+    import threading
+
+    latencies = []
+    errors = [0]
+    deadline = time.monotonic() + seconds
+
+    def run(offset):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        i = offset
+        while time.monotonic() < deadline:
+            token = tokens[i % len(tokens)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                conn.request('GET', '/movies', headers={'Authorization': 'Bearer ' + token})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[0] += 1
+            except (OSError, http.client.HTTPException):
+                errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=run, args=(n * 7,)) for n in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latencies, errors[0]))
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health/live')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start')
+
+
+def measure(env, workers, args, tokens):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+         '--threads', str(args.threads), '--bind', f'127.0.0.1:{args.port}'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(args.port)
+        results = multiprocessing.Queue()
+        processes = max(1, min(args.client_processes, args.clients))
+        clients = [multiprocessing.Process(
+                       target=client,
+                       args=(args.port, tokens, args.seconds, args.clients // processes, results))
+                   for _ in range(processes)]
+        for process in clients:
+            process.start()
+        latencies, errors = [], 0
+        for _ in clients:
+            batch, failed = results.get()
+            latencies.extend(batch)
+            errors += failed
+        for process in clients:
+            process.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    latencies.sort()
+    percentile = lambda p: latencies[int(p * (len(latencies) - 1))] * 1000 if latencies else 0.0
+    return {
+        'workers': workers,
+        'rps': len(latencies) / args.seconds,
+        'p50': percentile(0.50),
+        'p99': percentile(0.99),
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--client-processes', type=int, default=4)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--no-shared-cache', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        jwks_url, tokens = signing_setup(directory, args.tokens)
+        env = dict(os.environ,
+                   JWKS_URL=jwks_url, AUTH0_DOMAIN=DOMAIN, API_AUDIENCE=AUDIENCE,
+                   RATELIMIT_ENABLED='false', PORT=str(args.port),
+                   SHARED_CACHE_PATH='' if args.no_shared_cache else
+                   os.path.join(directory, 'shared.cache'))
+        env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        subprocess.run([sys.executable, '-m', 'flask', 'init-db'], cwd=ROOT, check=True,
+                       env=dict(env, FLASK_APP='app:create_app'))
+
+        print(f"{'workers':>8} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for workers in args.workers:
+            result = measure(env, workers, args, tokens)
+            print(f"{result['workers']:>8} {result['rps']:>10.1f} {result['p50']:>8.2f} "
+                  f"{result['p99']:>8.2f} {result['errors']:>7}")
+
+
+if __name__ == '__main__':
+    main()
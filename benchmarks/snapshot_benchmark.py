@@ -0,0 +1,119 @@
+'''
+Compares the columnar catalog snapshot with the JSON and NDJSON exports.
+
+For a synthetic catalog it writes the three files, then times a typical
+analytics scan on each: mean actor age per gender and cast size per movie.
+
+    python benchmarks/snapshot_benchmark.py --actors 200000 --movies 5000
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snapshot import load_snapshot, numpy, write_snapshot
+
+
+def synthetic_catalog(actors, movies, seed=0):
+    rng = random.Random(seed)
+    titles = [f'Movie {i % 500}' for i in range(movies)]
+    movie_rows = [{'id': i + 1, 'title': titles[i], 'release_date': f'{rng.randint(1950, 2024)}-01-01'}
+                  for i in range(movies)]
+    actor_rows = [{'id': i + 1,
+                   'name': f'Actor {i + 1}',
+                   'age': rng.randint(18, 90),
+                   'gender': rng.choice(('Female', 'Male', 'Non-binary')),
+                   'movie_id': rng.randint(1, movies) if rng.random() > 0.05 else None}
+                  for i in range(actors)]
+    return {'actors': actor_rows, 'movies': movie_rows}
+
+
+def scan_rows(actors):
+    ages = defaultdict(list)
+    cast = Counter()
+    for actor in actors:
+        ages[actor['gender']].append(actor['age'])
+        if actor['movie_id'] is not None:
+            cast[actor['movie_id']] += 1
+    return {gender: sum(v) / len(v) for gender, v in ages.items()}, len(cast)
+
+
+def scan_json(path):
+    with open(path) as export:
+        return scan_rows(json.load(export)['actors'])
+
+
+def scan_ndjson(path):
+    with open(path) as export:
+        return scan_rows(json.loads(line) for line in export if '"gender"' in line)
+
+
+def scan_snapshot(path):
+    actors = load_snapshot(path)['actors']
+    gender, age, movie_id = actors['gender'], actors['age'], actors['movie_id']
+    if numpy is not None:
+        totals = numpy.bincount(gender.codes, weights=age)
+        counts = numpy.bincount(gender.codes)
+        means = {gender.dictionary[code]: totals[code] / counts[code]
+                 for code in range(len(gender.dictionary)) if counts[code]}
+        return means, len(numpy.unique(movie_id[movie_id >= 0]))
+    totals, counts = Counter(), Counter()
+    for code, value in zip(gender.codes, age):
+        totals[code] += value
+        counts[code] += 1
+    means = {gender.dictionary[code]: totals[code] / counts[code] for code in counts}
+    return means, len({value for value in movie_id if value >= 0})
+
+
+def timed(fn, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--actors', type=int, default=200000)
+    parser.add_argument('--movies', type=int, default=5000)
+    args = parser.parse_args()
+
+    catalog = synthetic_catalog(args.actors, args.movies)
+    directory = tempfile.mkdtemp(prefix='snapshot-bench-')
+    paths = {name: os.path.join(directory, name)
+             for name in ('catalog.json', 'catalog.ndjson', 'catalog.col')}
+
+    with open(paths['catalog.json'], 'w') as export:
+        json.dump({'success': True, **catalog}, export)
+    with open(paths['catalog.ndjson'], 'w') as export:
+        for table in ('movies', 'actors'):
+            for row in catalog[table]:
+                export.write(json.dumps(row) + '\n')
+    write_snapshot(paths['catalog.col'], catalog)
+
+    print(f'{args.actors} actors, {args.movies} movies, '
+          f'numpy {"on" if numpy is not None else "off"}')
+    print(f'{"format":<10}{"bytes":>14}{"scan ms":>12}')
+    expected = None
+    for name, scan in (('json', scan_json), ('ndjson', scan_ndjson), ('columnar', scan_snapshot)):
+        path = paths[{'json': 'catalog.json', 'ndjson': 'catalog.ndjson',
+                      'columnar': 'catalog.col'}[name]]
+        elapsed, result = timed(scan, path)
+        means, cast = result
+        rounded = ({gender: round(mean, 6) for gender, mean in means.items()}, cast)
+        expected = expected or rounded
+        assert rounded == expected, f'{name} scan disagrees: {rounded} != {expected}'
+        print(f'{name:<10}{os.path.getsize(path):>14}{elapsed * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event
+from models import db, Change
+
+
+'''
+ChangeFeed
+    wakes the long-polls and event streams of this process as soon as one of
+    its commits writes to the change log; commits made by other processes
+    are picked up by polling the log every poll_interval seconds
+    every long-poll and stream holds a request thread of the worker, so at
+    most max_waiters of them may wait at once; hold() returns False when
+    they are all taken
+'''
+class ChangeFeed:
+    def __init__(self, poll_interval=1.0, max_waiters=2):
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._waiters = threading.BoundedSemaphore(max_waiters)
+
+    def hold(self):
+        return self._waiters.acquire(blocking=False)
+
+    def release(self):
+        self._waiters.release()
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout):
+        '''Waits up to timeout seconds for a commit; returns True if one came.'''
+        with self._condition:
+            generation = self._generation
+            return self._condition.wait_for(
+                lambda: self._generation != generation, timeout)
+
+
+'''
+init_change_feed(app)
+    gives the app a ChangeFeed that every commit writing changes notifies
+'''
+def init_change_feed(app):
+    app.extensions['changes'] = ChangeFeed(app.config.get('CHANGES_POLL_INTERVAL', 1.0),
+                                           app.config.get('CHANGES_MAX_WAITERS', 2))
+    if not event.contains(db.session, 'after_commit', notify_change_feed):
+        event.listen(db.session, 'after_commit', notify_change_feed)
+
+
+def notify_change_feed(session):
+    if session.info.pop('changes_written', False):
+        feed = current_app.extensions.get('changes')
+        if feed is not None:
+            feed.notify()
+
+
+def read_changes(since, limit, entities):
+    rows = (Change.query
+            .filter(Change.seq > since, Change.entity.in_(entities))
+            .order_by(Change.seq)
+            .limit(limit)
+            .all())
+    changes = [row.format() for row in rows]
+    # end the read transaction so the next read sees later commits
+    db.session.rollback()
+    return changes
+
+
+'''
+poll_changes(since, limit, entities, wait)
+    the changes after seq since, waiting up to wait seconds for the first one
+'''
+def poll_changes(since, limit, entities, wait):
+    feed = current_app.extensions['changes']
+    deadline = time.monotonic() + wait
+    changes = read_changes(since, limit, entities)
+    while not changes:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        feed.wait(min(feed.poll_interval, remaining))
+        changes = read_changes(since, limit, entities)
+    return changes
+
+
+'''
+stream_changes(since, limit, entities, duration, heartbeat)
+    server-sent events for the changes after seq since, one "change" event
+    per entry with the seq as its id, so a reconnecting EventSource resumes
+    from Last-Event-ID; a comment line is sent every heartbeat seconds of
+    silence and the stream ends after duration seconds, after which the
+    client reconnects
+'''
+def stream_changes(since, limit, entities, duration, heartbeat):
+    feed = current_app.extensions['changes']
+    deadline = time.monotonic() + duration
+    quiet_since = time.monotonic()
+    yield f'retry: {int(feed.poll_interval * 1000)}\n\n'
+    while time.monotonic() < deadline:
+        changes = read_changes(since, limit, entities)
+        for change in changes:
+            since = change['seq']
+            yield f'id: {since}\nevent: change\ndata: {json.dumps(change)}\n\n'
+        if changes:
+            quiet_since = time.monotonic()
+            continue
+        if time.monotonic() - quiet_since >= heartbeat:
+            quiet_since = time.monotonic()
+            yield ': keep-alive\n\n'
+        feed.wait(min(feed.poll_interval, max(deadline - time.monotonic(), 0)))
@@ -0,0 +1,118 @@
+import gzip
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+'''
+Response compression
+
+Responses are compressed with the best encoding the client accepts
+(Accept-Encoding q-values, ties broken by ENCODINGS order) once they reach
+COMPRESS_MIN_SIZE bytes. Streamed responses are sent as they are: flushing
+after every small chunk makes the output larger than the input. Brotli is
+used when the optional brotli package is installed.
+'''
+ENCODINGS = ('br', 'gzip', 'deflate') if brotli is not None else ('gzip', 'deflate')
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/plain')
+
+
+def negotiate(accept_encoding):
+    '''Returns the encoding to use for an Accept-Encoding header, or None.'''
+    weights = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(data, encoding, level=6):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    if encoding == 'deflate':
+        return zlib.compress(data, level)
+    raise ValueError(f'Unknown encoding: {encoding}')
+
+
+def _bytes(chunk):
+    return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+'''
+PrecompressedBody
+    a cached response body together with its compressed variants; each
+    encoding is compressed the first time a client asks for it and then
+    served from memory
+'''
+class PrecompressedBody:
+    def __init__(self, data, min_size=1024, level=6):
+        self.data = _bytes(data)
+        self.min_size = min_size
+        self.level = level
+        self._encoded = {}
+
+    def encode(self, accept_encoding):
+        '''Returns (data, encoding) for a client's Accept-Encoding header.'''
+        encoding = negotiate(accept_encoding)
+        if encoding is None or len(self.data) < self.min_size:
+            return self.data, None
+        data = self._encoded.get(encoding)
+        if data is None:
+            data = self._encoded.setdefault(encoding, compress(self.data, encoding, self.level))
+        return data, encoding
+
+
+'''
+init_compression(app)
+    compresses the app's eligible responses on the way out
+    responses that already carry a Content-Encoding (e.g. a PrecompressedBody)
+    are left alone
+'''
+def init_compression(app):
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return
+    min_size = app.config.get('COMPRESS_MIN_SIZE', 1024)
+    level = app.config.get('COMPRESS_LEVEL', 6)
+
+    @app.after_request
+    def compress_response(response):
+        response.vary.add('Accept-Encoding')
+        if (response.status_code != 200 or
+                'Content-Encoding' in response.headers or
+                response.is_streamed or
+                response.direct_passthrough or
+                response.mimetype not in COMPRESSIBLE):
+            return response
+
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,104 @@
+import os
+
+
+'''
+load_config(environ)
+    reads the application settings from the environment
+    create_app() calls it, so nothing is read from the environment at import
+    time; a test_config mapping passed to create_app() overrides any value
+'''
+def load_config(environ=None):
+    environ = os.environ if environ is None else environ
+
+    auth0_domain = environ.get('AUTH0_DOMAIN')
+    return {
+        'SQLALCHEMY_DATABASE_URI': database_url(environ.get('DATABASE_URL')),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SQLALCHEMY_REPLICA_URIS': [
+            database_url(url.strip())
+            for url in environ.get('DATABASE_REPLICA_URLS', '').split(',')
+            if url.strip()],
+        'REPLICA_STRATEGY': environ.get('REPLICA_STRATEGY', 'round_robin'),
+        # connections each process may hold per database; unset keeps
+        # SQLAlchemy's defaults (5 + 10), see gunicorn.conf.py
+        'DB_POOL_SIZE': optional_int(environ.get('DB_POOL_SIZE')),
+        'DB_MAX_OVERFLOW': optional_int(environ.get('DB_MAX_OVERFLOW')),
+        'AUTH0_DOMAIN': auth0_domain,
+        'API_AUDIENCE': environ.get('API_AUDIENCE'),
+        'JWKS_URL': environ.get('JWKS_URL') or f'https://{auth0_domain}/.well-known/jwks.json',
+        'JWKS_CACHE_TTL': int(environ.get('JWKS_CACHE_TTL', 600)),
+        'JWKS_MIN_REFRESH': int(environ.get('JWKS_MIN_REFRESH', 30)),
+        # seconds a verified token's payload is reused; 0 verifies every request
+        'TOKEN_CACHE_TTL': int(environ.get('TOKEN_CACHE_TTL', 300)),
+        # a file (e.g. under /dev/shm) that shares the JWKS and token caches
+        # between the workers of a host; unset keeps them per process
+        'SHARED_CACHE_PATH': environ.get('SHARED_CACHE_PATH'),
+        'SHARED_CACHE_SLOTS': int(environ.get('SHARED_CACHE_SLOTS', 4096)),
+        'SHARED_CACHE_SLOT_SIZE': int(environ.get('SHARED_CACHE_SLOT_SIZE', 2048)),
+        'EXCITED': environ.get('EXCITED') == 'true',
+        'HEALTH_CACHE_SECONDS': float(environ.get('HEALTH_CACHE_SECONDS', 2)),
+        'HEALTH_TIMEOUT': float(environ.get('HEALTH_TIMEOUT', 1)),
+        'HEALTH_MAX_POOL_SATURATION': float(environ.get('HEALTH_MAX_POOL_SATURATION', 0.9)),
+        'COMPRESS_ENABLED': environ.get('COMPRESS_ENABLED', 'true') == 'true',
+        'COMPRESS_MIN_SIZE': int(environ.get('COMPRESS_MIN_SIZE', 1024)),
+        'COMPRESS_LEVEL': int(environ.get('COMPRESS_LEVEL', 6)),
+        # how often a miss may reload the ids a body is checked against; see validation.py
+        'REFERENCE_REFRESH_SECONDS': float(environ.get('REFERENCE_REFRESH_SECONDS', 1)),
+        # sampling profiler, off unless enabled; see profiling.py
+        'PROFILE_ENABLED': environ.get('PROFILE_ENABLED') == 'true',
+        'PROFILE_SAMPLE_RATE': float(environ.get('PROFILE_SAMPLE_RATE', 0)),
+        'PROFILE_HEADER': environ.get('PROFILE_HEADER', 'X-Profile'),
+        'PROFILE_TOKEN': environ.get('PROFILE_TOKEN'),
+        'PROFILE_INTERVAL': float(environ.get('PROFILE_INTERVAL', 0.005)),
+        # GET /changes long-polls and event streams; see changes.py
+        'CHANGES_POLL_INTERVAL': float(environ.get('CHANGES_POLL_INTERVAL', 1)),
+        'CHANGES_MAX_WAIT': float(environ.get('CHANGES_MAX_WAIT', 10)),
+        'CHANGES_MAX_LIMIT': int(environ.get('CHANGES_MAX_LIMIT', 1000)),
+        'CHANGES_STREAM_SECONDS': float(environ.get('CHANGES_STREAM_SECONDS', 60)),
+        # long-polls and streams waiting at once per worker; keep it below
+        # GUNICORN_THREADS so they cannot take every request thread
+        'CHANGES_MAX_WAITERS': int(environ.get('CHANGES_MAX_WAITERS', 2)),
+        'CHANGES_HEARTBEAT_SECONDS': float(environ.get('CHANGES_HEARTBEAT_SECONDS', 15)),
+        # reverse proxies (load balancers) in front of the app whose
+        # X-Forwarded-* headers are trusted; 0 uses the peer address as is
+        'PROXY_FIX_HOPS': int(environ.get('PROXY_FIX_HOPS', 0)),
+        # (tokens per second, burst); see ratelimit.py
+        'RATELIMIT_ENABLED': environ.get('RATELIMIT_ENABLED', 'true') == 'true',
+        'RATELIMIT_BACKEND': environ.get('RATELIMIT_BACKEND'),
+        'RATELIMIT_IP': rate_limit(environ.get('RATELIMIT_IP', '20,40')),
+        'RATELIMIT_SUBJECT': rate_limit(environ.get('RATELIMIT_SUBJECT', '10,20')),
+        'RATELIMIT_PERMISSIONS': {
+            'post:actors': (1.0, 10),
+            'post:movies': (1.0, 10),
+            'delete:actors': (1.0, 10),
+            'delete:movies': (1.0, 10),
+        },
+    }
+
+
+def pool_options(config):
+    '''The create_engine() pool arguments set by DB_POOL_SIZE and DB_MAX_OVERFLOW.'''
+    options = {}
+    if config.get('DB_POOL_SIZE') is not None:
+        options['pool_size'] = config['DB_POOL_SIZE']
+    if config.get('DB_MAX_OVERFLOW') is not None:
+        options['max_overflow'] = config['DB_MAX_OVERFLOW']
+    return options
+
+
+def optional_int(value):
+    return int(value) if value else None
+
+
+def database_url(url):
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+def rate_limit(value):
+    """Parses a "rate,burst" pair; an empty value disables the limit."""
+    if not value:
+        return None
+    rate, burst = value.split(',')
+    return float(rate), int(burst)
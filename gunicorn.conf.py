@@ -0,0 +1,67 @@
+'''
+Production server settings, read by gunicorn from the working directory:
+
+    gunicorn
+
+Every setting can be overridden on the command line or through the
+environment variables below.
+
+- preload_app: create_app() connects to nothing and every per-process
+  resource (pools, locks, caches) is created on first use or reset after
+  fork, so the app is imported once in the master and forked into workers
+- gthread workers: requests spend most of their time waiting on Postgres
+  and Auth0, so each worker serves GUNICORN_THREADS requests at once
+- the JWKS key set and verified tokens are shared by every worker through
+  SHARED_CACHE_PATH (see sharedcache.py), so adding workers does not add
+  fetches, verifications or cache memory
+- each worker's connection pool is sized from its threads: DB_POOL_SIZE
+  defaults to GUNICORN_THREADS and DB_MAX_OVERFLOW to 2 (the readiness
+  probe and a spare), so a host opens at most
+  workers * (threads + 2) connections per database; keep that below the
+  server's max_connections (Postgres defaults to 100), lowering
+  WEB_CONCURRENCY on large hosts
+'''
+import hashlib
+import multiprocessing
+import os
+import tempfile
+
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+
+# read by create_app() when the app is preloaded
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+os.environ.setdefault('DB_MAX_OVERFLOW', '2')
+
+# long-polls and event streams of GET /changes hold a thread, not the
+# worker's heartbeat, so timeout only catches a worker that is really stuck
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+# recycle workers now and then so a slow leak cannot grow without bound;
+# the jitter keeps them from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+
+# heartbeat files on a RAM disk, so a slow disk cannot stall workers
+shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+worker_tmp_dir = shm
+
+# set before the app is preloaded, which is when it reads its config; the
+# cache holds verified tokens, so it is keyed by the checkout and the Auth0
+# tenant it trusts as well as the port, never shared with another deployment
+deployment = hashlib.sha256('\0'.join([
+    os.getcwd(), os.environ.get('AUTH0_DOMAIN', ''), os.environ.get('API_AUDIENCE', ''),
+]).encode('utf-8')).hexdigest()[:12]
+os.environ.setdefault(
+    'SHARED_CACHE_PATH',
+    os.path.join(shm, f"casting-agency-{os.environ.get('PORT', '8000')}-{deployment}.cache"))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
@@ -0,0 +1,103 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import Lock
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+from singleflight import SingleFlight
+
+
+'''
+ReadinessProbe
+    checks the dependencies a worker needs to serve traffic:
+    - database: a pooled connection can be checked out and answers SELECT 1
+      within db_timeout seconds
+    - pool: the share of the connection pool in use (of pool_size plus
+      max_overflow, as configured); a worker at or above max_saturation
+      reports not ready so the balancer sheds load early
+    - jwks: the cached Auth0 key set is fresh, or can be refetched within
+      db_timeout seconds
+    each dependency is checked on its own helper thread, so a hung database
+    cannot hold up the JWKS check; a check still running from an earlier
+    probe is waited on again instead of being started twice
+    results are cached for cache_seconds and concurrent probes share one
+    run, so probing stays cheap however often the balancer asks
+'''
+class ReadinessProbe:
+    def __init__(self, engine, key_set, cache_seconds=2.0, timeout=1.0, max_saturation=0.9,
+                 max_overflow=10):
+        self.engine = engine
+        self.key_set = key_set
+        self.cache_seconds = cache_seconds
+        self.timeout = timeout
+        self.max_saturation = max_saturation
+        self.max_overflow = max_overflow
+        self._cached = (None, 0.0)
+        self._runs = SingleFlight()
+        self._executors = {}
+        self._pending = {}
+        self._lock = Lock()
+
+    def check(self):
+        '''Returns (ready, checks).'''
+        result, checked_at = self._cached
+        if result is None or time.monotonic() - checked_at > self.cache_seconds:
+            result = self._runs.do('ready', self._run)
+        return result
+
+    def _run(self):
+        checks = {
+            'database': self._with_timeout('database', self._check_database),
+            'pool': self._check_pool(),
+            'jwks': self._check_jwks(),
+        }
+        ready = all(check['ok'] for check in checks.values())
+        self._cached = ((ready, checks), time.monotonic())
+        return ready, checks
+
+    def _with_timeout(self, name, check):
+        # a hung connect must not hang the probe, so it runs on a helper thread
+        started = time.monotonic()
+        try:
+            self._submit(name, check).result(timeout=self.timeout)
+        except TimeoutError:
+            return {'ok': False, 'error': f'timed out after {self.timeout}s'}
+        except Exception as e:
+            # the endpoint is public: name the failure, keep its details out
+            return {'ok': False, 'error': type(e).__name__}
+        return {'ok': True, 'ms': round((time.monotonic() - started) * 1000, 1)}
+
+    def _submit(self, name, check):
+        with self._lock:
+            future = self._pending.get(name)
+            if future is None or future.done():
+                executor = self._executors.get(name)
+                if executor is None:
+                    executor = self._executors[name] = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix=f'readiness-{name}')
+                future = self._pending[name] = executor.submit(check)
+            return future
+
+    def _check_database(self):
+        with self.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+
+    def _check_pool(self):
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return {'ok': True, 'type': type(pool).__name__}
+        capacity = pool.size() + max(self.max_overflow, 0)
+        saturation = pool.checkedout() / capacity if capacity else 0.0
+        return {
+            'ok': saturation < self.max_saturation,
+            'checked_out': pool.checkedout(),
+            'capacity': capacity,
+            'saturation': round(saturation, 2),
+        }
+
+    def _check_jwks(self):
+        age = self.key_set.age()
+        if age is not None and age <= self.key_set.ttl:
+            return {'ok': True, 'age': round(age, 1)}
+        check = self._with_timeout('jwks', self.key_set.get)
+        check['age'] = None if age is None else round(age, 1)
+        return check
@@ -1,26 +1,69 @@
 from dataclasses import dataclass
+from datetime import datetime, timedelta
 import os
-from sqlalchemy import Column, String, Integer, create_engine, ForeignKey
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Integer, Text, DateTime, Table, Index, create_engine, ForeignKey, ForeignKeyConstraint, MetaData, update, delete, select, insert, event, inspect, exists, literal, and_
+from sqlalchemy.schema import AddConstraint, DropConstraint
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import Pool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.orm import relationship, backref, sessionmaker, selectinload
+from config import database_url, pool_options
+from replicas import init_replicas, replica_engine
 import json
 
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+'''
+RoutingSession
+    sends the statements of a @read_only request to the replica chosen for
+    it; everything else, and every flush, goes to the primary
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        engine = replica_engine()
+        if engine is not None and not self._flushing:
+            return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
 
-# print(f"Database URL test: {database_path}") 
-db = SQLAlchemy()
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the database URL comes from database_path, the app config or
+    DATABASE_URL, in that order; engines connect on first use, not here
+    read replicas are optional: see SQLALCHEMY_REPLICA_URIS in config.py
+    DB_POOL_SIZE and DB_MAX_OVERFLOW size the pools of the primary and the
+    replicas alike; SQLite files keep their own pool
 '''
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url(
+        database_path or app.config.get("SQLALCHEMY_DATABASE_URI") or os.environ['DATABASE_URL'])
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if not app.config["SQLALCHEMY_DATABASE_URI"].startswith('sqlite'):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+            app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {}, **pool_options(app.config))
     db.app = app
     db.init_app(app)
+    init_replicas(app, db)
+
+'''
+Pooled connections must not cross a fork: a worker that finds a connection
+opened by its parent (e.g. a gunicorn --preload master) discards it and opens
+its own, leaving the parent's socket alone
+'''
+@event.listens_for(Pool, 'connect')
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(Pool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get('pid') != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise DisconnectionError('Connection belongs to another process')
 
 '''
     db_drop_and_create_all()
@@ -30,8 +73,17 @@ def setup_db(app, database_path=database_path):
 '''
 
 def db_drop_and_create_all():
+    # carry the read model revision over the reseed: lists cached from the
+    # old data (by any process) are labelled with a lower revision and are
+    # never served for the new data
+    revision = 0
+    if inspect(db.engine).has_table(ReadModelRevision.__tablename__):
+        revision = read_model_revision()
+    db.session.rollback()
     db.drop_all()
     db.create_all()
+    db.session.execute(insert(ReadModelRevision.__table__).values(id=1, revision=revision))
+    rebuild_read_model()
 
     # add one demo row which is helping in POSTMAN test
     movie = Movie(title='Movie1', release_date="jan")
@@ -60,7 +112,73 @@ class dbCrudOperations(db.Model):
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+
+    '''
+    bulk_update(criteria, values) / bulk_delete(criteria)
+        apply one set-based UPDATE/DELETE to every row matching criteria
+        inside a single transaction and return the affected ids
+    '''
+    @classmethod
+    def bulk_update(cls, criteria, values):
+        stmt = update(cls.__table__).where(*criteria).values(**values)
+        return cls._execute_bulk(stmt, criteria, values)
+
+    @classmethod
+    def bulk_delete(cls, criteria):
+        stmt = delete(cls.__table__).where(*criteria)
+        return cls._execute_bulk(stmt, criteria, None)
+
+    '''
+    before_bulk(criteria, values) / after_bulk(ids, values, before)
+        bulk statements bypass the flush events, so each model keeps its
+        castings and the read model in step by hand, inside the bulk
+        transaction; values is None for a delete
+    '''
+    @classmethod
+    def before_bulk(cls, criteria, values):
+        return None
+
+    @classmethod
+    def after_bulk(cls, ids, values, before):
+        pass
+
+    @classmethod
+    def _execute_bulk(cls, stmt, criteria, values):
+        try:
+            before = cls.before_bulk(criteria, values)
+            if db.engine.dialect.full_returning:
+                # postgres hands the ids back from the statement itself
+                ids = [row[0] for row in db.session.execute(stmt.returning(cls.id))]
+            else:
+                # lock the matching rows so the id list and the change agree
+                ids = [row[0] for row in db.session.execute(
+                    select(cls.id).where(*criteria).with_for_update())]
+                if ids:
+                    db.session.execute(stmt.where(cls.id.in_(ids)))
+            if ids:
+                cls.after_bulk(ids, values, before)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return sorted(ids)
   
+"""
+Creating Casting table
+
+Which actors play in which movies. The primary key (movie_id, actor_id)
+serves movie -> cast lookups and ix_castings_actor_movie the reverse, so
+both directions are a single index range scan.
+Actor.movie_id is kept for compatibility: setting it casts the actor in
+that movie (and uncasts it from the previous one).
+"""
+castings = Table(
+    'castings', db.metadata,
+    Column('movie_id', Integer, ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer, ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_castings_actor_movie', 'actor_id', 'movie_id'),
+)
+
 """
 Creating Movie Table
 
@@ -72,7 +190,8 @@ class Movie(dbCrudOperations):
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(String)
-    actors = relationship('Actor', backref="movie", lazy=True)
+    actors = relationship('Actor', secondary=castings, order_by='Actor.id', lazy=True,
+                          backref=backref('movies', order_by='Movie.id', lazy=True))
 
     def __init__(self, title, release_date):
         self.title = title
@@ -81,13 +200,28 @@ class Movie(dbCrudOperations):
     #def __repr__(self):
     #    return f'<movies: id: {self.id.data}'
 
-    def format(self):
-        return {
+    def format(self, actors=True):
+        movie = {
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date,
-            'actors': list(map(lambda actor: actor.format(), self.actors))
         }
+        if actors:
+            movie['actors'] = list(map(lambda actor: actor.format(), self.actors))
+        return movie
+
+    @classmethod
+    def before_bulk(cls, criteria, values):
+        if values is None:
+            release_actors(db.session, select(cls.id).where(*criteria))
+
+    @classmethod
+    def after_bulk(cls, ids, values, before):
+        if values is None:
+            db.session.execute(delete(castings).where(castings.c.movie_id.in_(ids)))
+            # (added, removed) movie ids, applied to validation's IdSet on commit
+            db.session.info.setdefault('movie_ids', (set(), set()))[1].update(ids)
+        mark_movies_stale(db.session, ids)
 
 """
 Creating Actor table
@@ -101,7 +235,8 @@ class Actor(dbCrudOperations):
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
-    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=True)
+    # a deleted movie releases its actors; see release_actors
+    movie_id = Column(Integer, ForeignKey('movies.id', ondelete='SET NULL'), nullable=True)
 
     def __init__(self, name,age,gender,movie_id):
         self.name = name
@@ -118,3 +253,320 @@ class Actor(dbCrudOperations):
             'movie_id':self.movie_id
           }  
 
+    @classmethod
+    def before_bulk(cls, criteria, values):
+        # every movie the matching actors are cast in, and their movie_id
+        actor_ids = select(cls.id).where(*criteria)
+        cast_in = {row[0] for row in db.session.execute(
+            select(castings.c.movie_id).where(castings.c.actor_id.in_(actor_ids)).distinct())}
+        legacy = dict(db.session.execute(select(cls.id, cls.movie_id).where(*criteria)).all())
+        return cast_in, legacy
+
+    @classmethod
+    def after_bulk(cls, ids, values, before):
+        cast_in, legacy = before
+        stale = set(cast_in)
+        if values is None:
+            db.session.execute(delete(castings).where(castings.c.actor_id.in_(ids)))
+        elif values.get('movie_id') is not None:
+            for actor_id in ids:
+                recast(db.session, actor_id, legacy.get(actor_id), values['movie_id'])
+            stale.add(values['movie_id'])
+        mark_movies_stale(db.session, stale)
+        mark_actors_changed(db.session, ids)
+
+'''
+recast(session, actor_id, old_movie_id, new_movie_id)
+    moves the casting that mirrors Actor.movie_id from the old movie to the
+    new one, leaving the actor's other castings alone
+'''
+def recast(session, actor_id, old_movie_id, new_movie_id):
+    if old_movie_id == new_movie_id:
+        return
+    if old_movie_id is not None:
+        session.execute(delete(castings).where(
+            castings.c.actor_id == actor_id, castings.c.movie_id == old_movie_id))
+    if new_movie_id is not None:
+        already_cast = exists().where(and_(
+            castings.c.actor_id == actor_id, castings.c.movie_id == new_movie_id))
+        session.execute(insert(castings).from_select(
+            ['movie_id', 'actor_id'],
+            select(literal(new_movie_id), literal(actor_id)).where(~already_cast)))
+
+'''
+release_actors(session, movie_ids)
+    clears actors.movie_id for movies that are about to be deleted, so the
+    foreign key lets them go; movie_ids may be a list or a SELECT of ids
+    the column is also ON DELETE SET NULL, but clearing it here records the
+    change in the change log and keeps databases that predate it working
+'''
+def release_actors(session, movie_ids):
+    table = Actor.__table__
+    actor_ids = [row[0] for row in session.execute(
+        select(table.c.id).where(table.c.movie_id.in_(movie_ids)))]
+    if actor_ids:
+        session.execute(update(table).where(table.c.id.in_(actor_ids)).values(movie_id=None))
+        mark_actors_changed(session, actor_ids)
+
+@event.listens_for(db.session, 'before_flush')
+def release_deleted_movies(session, flush_context, instances):
+    movie_ids = [obj.id for obj in session.deleted
+                 if isinstance(obj, Movie) and obj.id is not None]
+    if movie_ids:
+        release_actors(session, movie_ids)
+
+'''
+create_missing_tables()
+    creates the tables added since the first release (castings, the read
+    model and the change log) on a database that predates them; existing
+    tables and their rows are left alone
+    every write needs the read model and change log tables, so an upgraded
+    database must run this (through migrate-castings or rebuild-read-model)
+    before it takes traffic
+'''
+def create_missing_tables():
+    db.create_all()
+
+'''
+migrate_castings()
+    creates the tables a database that predates castings is missing, folds
+    every actor's movie_id into castings and makes actors.movie_id ON DELETE
+    SET NULL; safe to run more than once
+'''
+def migrate_castings():
+    create_missing_tables()
+    already_cast = exists().where(and_(
+        castings.c.actor_id == Actor.id, castings.c.movie_id == Actor.movie_id))
+    db.session.execute(insert(castings).from_select(
+        ['movie_id', 'actor_id'],
+        select(Actor.movie_id, Actor.id).where(Actor.movie_id.isnot(None), ~already_cast)))
+    db.session.commit()
+    migrate_actor_movie_fk()
+
+def migrate_actor_movie_fk():
+    # SQLite cannot alter a constraint; its tables get the new one when recreated
+    if db.engine.dialect.name == 'sqlite':
+        return
+    for fk in inspect(db.engine).get_foreign_keys('actors'):
+        if (fk['referred_table'] != 'movies' or
+                fk.get('options', {}).get('ondelete', '').upper() == 'SET NULL'):
+            continue
+        # a detached copy of the two tables, so the DDL names the right columns
+        metadata = MetaData()
+        Table('movies', metadata, *[Column(column, Integer) for column in fk['referred_columns']])
+        constraint = ForeignKeyConstraint(
+            fk['constrained_columns'],
+            ['movies.' + column for column in fk['referred_columns']],
+            name=fk['name'], ondelete='SET NULL')
+        Table('actors', metadata, *[Column(column, Integer) for column in fk['constrained_columns']],
+              constraint)
+        with db.engine.begin() as connection:
+            connection.execute(DropConstraint(constraint))
+            connection.execute(AddConstraint(constraint))
+
+"""
+Movie read model
+
+movie_documents holds the serialized Movie.format() of every movie, cast
+included, so GET /movies is a concatenation of pre-rendered fragments.
+Every transaction that touches a movie or an actor re-renders the affected
+documents just before it commits. read_model_revision is bumped first: its
+row lock serialises the re-renders, so each one reads the cast as committed
+by the writers before it, and the revision tells readers when their copy of
+the list is stale.
+"""
+class MovieDocument(db.Model):
+    __tablename__ = 'movie_documents'
+
+    movie_id = Column(Integer, primary_key=True)
+    document = Column(Text, nullable=False)
+
+
+class ReadModelRevision(db.Model):
+    __tablename__ = 'read_model_revision'
+
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+
+
+"""
+Change log
+
+One row per movie or actor that a transaction changed, written in that
+transaction right after the read model, while read_model_revision is still
+locked: seq therefore grows in commit order and a client that has applied
+everything up to seq N never misses a later change. data is the movie's
+read model document (cast included) or the actor's format(), and None for
+a delete.
+"""
+class Change(db.Model):
+    __tablename__ = 'changes'
+
+    seq = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+    data = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def format(self):
+        return {
+            'seq': self.seq,
+            'entity': self.entity,
+            'id': self.entity_id,
+            'op': self.op,
+            'data': json.loads(self.data) if self.data is not None else None
+        }
+
+
+def render(document):
+    return json.dumps(document, sort_keys=True, separators=(',', ':'))
+
+def render_movie(movie):
+    return render(movie.format())
+
+def mark_movies_stale(session, movie_ids):
+    stale = session.info.setdefault('stale_movies', set())
+    stale.update(movie_id for movie_id in movie_ids if movie_id is not None)
+
+def mark_actors_changed(session, actor_ids):
+    session.info.setdefault('changed_actors', set()).update(actor_ids)
+
+@event.listens_for(db.session, 'before_flush')
+def track_cast_movies(session, flush_context, instances):
+    # an actor that changes or goes away alters every movie it is cast in
+    actor_ids = [obj.id for obj in session.dirty | session.deleted
+                 if isinstance(obj, Actor) and obj.id is not None]
+    if actor_ids:
+        mark_movies_stale(session, [row[0] for row in session.execute(
+            select(castings.c.movie_id).where(castings.c.actor_id.in_(actor_ids)).distinct())])
+
+@event.listens_for(db.session, 'after_flush')
+def track_stale_movies(session, flush_context):
+    # new/dirty/deleted and attribute history still describe the flush here
+    stale = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Movie):
+            stale.add(obj.id)
+        elif isinstance(obj, Actor):
+            if obj in session.new or obj in session.deleted or session.is_modified(obj):
+                mark_actors_changed(session, [obj.id])
+            state = inspect(obj)
+            history = state.attrs.movie_id.history
+            stale.update(history.added or ())
+            stale.update(history.unchanged or ())
+            stale.update(history.deleted or ())
+            movies = state.attrs.movies.history
+            stale.update(movie.id for movie in movies.added or ())
+            stale.update(movie.id for movie in movies.deleted or ())
+            if obj not in session.deleted and (history.added or history.deleted):
+                recast(session, obj.id, (history.deleted or [None])[0], (history.added or [None])[0])
+    mark_movies_stale(session, stale)
+
+@event.listens_for(db.session, 'before_commit')
+def refresh_read_model(session):
+    session.flush()
+    stale = session.info.pop('stale_movies', None)
+    actors = session.info.pop('changed_actors', None)
+    if not stale and not actors:
+        return
+
+    bump_read_model_revision(session)
+    if actors:
+        # the casts were read before the lock: a writer that cast one of these
+        # actors since then has committed by now, and rendered its movie with
+        # the actor as it was, so those movies are re-rendered too
+        stale = set(stale or ()) | {row[0] for row in session.execute(
+            select(castings.c.movie_id).where(castings.c.actor_id.in_(actors)).distinct())}
+    documents = refresh_movie_documents(session, stale) if stale else {}
+    record_changes(session, documents, actors or ())
+    session.info['changes_written'] = True
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_stale_movies(session):
+    session.info.pop('stale_movies', None)
+    session.info.pop('changed_actors', None)
+    session.info.pop('changes_written', None)
+
+def bump_read_model_revision(session):
+    table = ReadModelRevision.__table__
+    result = session.execute(
+        update(table).where(table.c.id == 1).values(revision=table.c.revision + 1))
+    if result.rowcount == 0:
+        session.execute(insert(table).values(id=1, revision=1))
+
+'''
+refresh_movie_documents(session, movie_ids)
+    re-renders the documents of movie_ids and returns them by movie id, None
+    for a movie that no longer exists; the caller holds the revision lock
+'''
+def refresh_movie_documents(session, movie_ids):
+    # populate_existing: the cast must come from the database as it is now,
+    # not from collections this session loaded before the lock
+    movies = (session.query(Movie)
+              .filter(Movie.id.in_(movie_ids))
+              .options(selectinload(Movie.actors))
+              .populate_existing()
+              .all())
+
+    documents = dict.fromkeys(movie_ids)
+    documents.update((movie.id, render_movie(movie)) for movie in movies)
+
+    table = MovieDocument.__table__
+    session.execute(delete(table).where(table.c.movie_id.in_(movie_ids)))
+    if movies:
+        session.execute(insert(table), [
+            {'movie_id': movie.id, 'document': documents[movie.id]}
+            for movie in movies])
+    return documents
+
+def prune_changes(days):
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    result = db.session.execute(delete(Change.__table__).where(Change.created_at < cutoff))
+    db.session.commit()
+    return result.rowcount
+
+def record_changes(session, documents, actor_ids):
+    rows = [{'entity': 'movie', 'entity_id': movie_id,
+             'op': 'delete' if document is None else 'upsert', 'data': document}
+            for movie_id, document in sorted(documents.items())]
+
+    if actor_ids:
+        actors = {actor.id: actor for actor in session.query(Actor)
+                  .filter(Actor.id.in_(actor_ids))
+                  .populate_existing()}
+        for actor_id in sorted(actor_ids):
+            actor = actors.get(actor_id)
+            rows.append({'entity': 'actor', 'entity_id': actor_id,
+                         'op': 'delete' if actor is None else 'upsert',
+                         'data': None if actor is None else render(actor.format())})
+
+    if rows:
+        session.execute(insert(Change.__table__), rows)
+
+'''
+rebuild_read_model()
+    renders every movie document from scratch, e.g. after upgrading a
+    database that predates the read model
+'''
+def rebuild_read_model():
+    bump_read_model_revision(db.session)
+    db.session.execute(delete(MovieDocument.__table__))
+    movie_ids = [row[0] for row in db.session.execute(select(Movie.id))]
+    refresh_movie_documents(db.session, movie_ids)
+    db.session.commit()
+
+'''
+read_model_revision() / movie_documents()
+    read the revision before the documents it labels: a reader may then
+    label a newer list with an older revision, which only costs a refetch,
+    but never an older list with a newer one
+'''
+def read_model_revision():
+    return db.session.execute(
+        select(ReadModelRevision.revision).where(ReadModelRevision.id == 1)).scalar() or 0
+
+def movie_documents():
+    return [row[0] for row in db.session.execute(
+        select(MovieDocument.document).order_by(MovieDocument.movie_id))]
+
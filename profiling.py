@@ -0,0 +1,135 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from flask import current_app, g, request
+
+
+'''
+StackSampler
+    a sampling profiler for request threads: while a thread is registered, a
+    single background thread records its Python stack every interval
+    seconds and counts each distinct stack under the request's label
+    stacks() returns the counts in collapsed form ("label;outer;...;inner"),
+    the input format of flamegraph.pl and speedscope
+    the profiled request only pays for registering its thread; the cost of
+    walking its stack is paid on the sampler thread
+    the sampler runs when the request thread releases the GIL, so samples
+    gather at I/O (queries, connects) and switch points; long stretches of
+    pure Python are under-counted
+    the background thread exits once no thread is registered and the next
+    start() begins a new one; join() waits for it to finish
+'''
+class StackSampler:
+    def __init__(self, interval=0.005, max_stacks=20000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._thread = None
+        self._stacks = Counter()
+        self._requests = Counter()
+
+    def start(self, label):
+        with self._lock:
+            self._threads[threading.get_ident()] = label
+            self._requests[label] += 1
+            if self._thread is None or not self._thread.is_alive():
+                # started on first use, so it also exists in forked workers
+                self._thread = threading.Thread(
+                    target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+
+    def join(self, timeout=None):
+        '''Waits for the sampler thread to exit once no thread is registered.'''
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stacks(self, reset=False):
+        '''Returns (collapsed stack counts, profiled requests per label).'''
+        with self._lock:
+            stacks, requests = dict(self._stacks), dict(self._requests)
+            if reset:
+                self._stacks.clear()
+                self._requests.clear()
+        return stacks, requests
+
+    def _run(self):
+        while True:
+            with self._lock:
+                threads = dict(self._threads)
+                if not threads:
+                    # under the lock, so a start() racing this exit sees
+                    # no thread and begins a new one
+                    self._thread = None
+                    return
+
+            frames = sys._current_frames()
+            samples = [(label, collapse(frames[ident]))
+                       for ident, label in threads.items() if ident in frames]
+            del frames
+            with self._lock:
+                for label, stack in samples:
+                    key = f'{label};{stack}'
+                    if key not in self._stacks and len(self._stacks) >= self.max_stacks:
+                        key = f'{label};[other]'
+                    self._stacks[key] += 1
+            time.sleep(self.interval)
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+'''
+init_profiling(app)
+    with PROFILE_ENABLED, samples PROFILE_SAMPLE_RATE of the app's requests,
+    plus every request whose PROFILE_HEADER carries PROFILE_TOKEN
+    with profiling off nothing is registered, so requests run exactly as
+    they would without this module
+'''
+def init_profiling(app):
+    if not app.config.get('PROFILE_ENABLED', False):
+        return
+
+    sampler = app.extensions['profiler'] = StackSampler(
+        interval=app.config.get('PROFILE_INTERVAL', 0.005))
+    rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+    header = app.config.get('PROFILE_HEADER', 'X-Profile')
+    token = app.config.get('PROFILE_TOKEN')
+
+    def requested():
+        value = request.headers.get(header)
+        # compare_digest rejects non-ASCII str, and a header may carry any byte
+        return bool(token and value and
+                    hmac.compare_digest(value.encode('utf-8'), token.encode('utf-8')))
+
+    @app.before_request
+    def start_profile():
+        if random.random() < rate or requested():
+            rule = request.url_rule.rule if request.url_rule is not None else request.path
+            sampler.start(f'{request.method} {rule}')
+            g.profiled = True
+
+    @app.teardown_request
+    def stop_profile(error=None):
+        if g.pop('profiled', False):
+            sampler.stop()
+
+
+def profiler():
+    return current_app.extensions.get('profiler')
@@ -0,0 +1,125 @@
+import importlib
+import math
+import time
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+
+'''
+MemoryBackend
+    in-process token buckets, one per key, kept as a single "theoretical
+    arrival time" float (GCRA): a take is one dict read and one dict write,
+    with no lock on the request path
+    two threads racing on the same key may both be let through, so a bucket
+    can overshoot by at most one token per concurrent thread
+    any object with the same take(key, rate, burst) method can replace it,
+    e.g. a client for a store shared by every worker
+'''
+class MemoryBackend:
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._arrivals = {}
+
+    def take(self, key, rate, burst):
+        '''Takes one token; returns 0 or the seconds until one is available.'''
+        now = self.clock()
+        interval = 1.0 / rate
+        arrival = max(self._arrivals.get(key, now), now) + interval
+        allowed_at = arrival - burst * interval
+        if allowed_at > now:
+            return allowed_at - now
+
+        if len(self._arrivals) >= self.max_keys:
+            self._forget_full_buckets(now)
+        self._arrivals[key] = arrival
+        return 0.0
+
+    def _forget_full_buckets(self, now):
+        # a bucket whose arrival time has passed is full again, so it can go
+        for key, arrival in list(self._arrivals.items()):
+            if arrival <= now:
+                self._arrivals.pop(key, None)
+
+
+'''
+RateLimiter
+    applies the limits of one app, each a (tokens per second, burst) pair:
+    - ip_limit to every request, keyed by client IP, before any auth work
+    - permission_limits[permission] (or subject_limit) to authenticated
+      routes, keyed by the verified token's "sub" claim and the route's
+      permission
+'''
+class RateLimiter:
+    def __init__(self, backend, ip_limit, subject_limit, permission_limits=None):
+        self.backend = backend
+        self.ip_limit = ip_limit
+        self.subject_limit = subject_limit
+        self.permission_limits = permission_limits or {}
+
+    def check_ip(self, address):
+        self._take(('ip', address), self.ip_limit)
+
+    def check_subject(self, subject, permission):
+        limit = self.permission_limits.get(permission, self.subject_limit)
+        self._take(('sub', subject, permission), limit)
+
+    def _take(self, key, limit):
+        if limit is None:
+            return
+        rate, burst = limit
+        wait = self.backend.take(key, rate, burst)
+        if wait:
+            raise TooManyRequests('Rate limit exceeded.', retry_after=math.ceil(wait))
+
+
+PROBE_PATHS = frozenset(('/health/live', '/health/ready'))
+
+
+'''
+init_rate_limits(app)
+    builds the app's RateLimiter from the RATELIMIT_* settings and rejects
+    over-limit clients before any other request handling
+    RATELIMIT_BACKEND may be a backend object or a "module:factory" string
+    the balancer's liveness and readiness probes are exempt: behind a proxy
+    they share its address with client traffic, and a 429 there would pull
+    healthy workers out of rotation
+    the client IP is request.remote_addr, which behind PROXY_FIX_HOPS
+    trusted proxies is taken from X-Forwarded-For (see create_app)
+'''
+def init_rate_limits(app):
+    if not app.config.get('RATELIMIT_ENABLED', True):
+        return
+
+    backend = app.config.get('RATELIMIT_BACKEND') or MemoryBackend()
+    if isinstance(backend, str):
+        module, _, factory = backend.partition(':')
+        backend = getattr(importlib.import_module(module), factory)()
+
+    app.extensions['ratelimit'] = RateLimiter(
+        backend,
+        ip_limit=app.config.get('RATELIMIT_IP'),
+        subject_limit=app.config.get('RATELIMIT_SUBJECT'),
+        permission_limits=app.config.get('RATELIMIT_PERMISSIONS'))
+
+    @app.before_request
+    def limit_client_ip():
+        if request.path not in PROBE_PATHS:
+            app.extensions['ratelimit'].check_ip(request.remote_addr)
+
+
+def check_rate_limit(payload, permission):
+    '''
+    Applies the subject limit of a route to a verified token payload.
+
+    It must only see payloads whose signature has been checked (or that came
+    from the verified-token cache): keyed on an unverified "sub", anyone
+    could forge a victim's subject and drain their bucket. Until then only
+    the client IP limit applies.
+    '''
+    limiter = current_app.extensions.get('ratelimit')
+    if limiter is None:
+        return
+    subject = payload.get('sub')
+    if subject:
+        limiter.check_subject(subject, permission)
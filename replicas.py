@@ -0,0 +1,161 @@
+import itertools
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import SQLAlchemyError
+from auth import cache_store
+from config import pool_options
+from sharedcache import MemoryStore
+
+
+'''
+ReplicaRouter
+    holds the read replica engines of one app and picks one per request,
+    round-robin or by least checked-out connections
+    a replica that raises a database error is skipped for retry_seconds and
+    its requests are replayed on the primary
+    subjects that wrote recently are pinned to the primary for
+    read_your_writes_seconds so they always read their own writes; the pins
+    live in the store pins() returns (see sharedcache.py), which the gunicorn
+    profile shares between workers, so a read that follows a write on
+    another worker is pinned as well
+'''
+class ReplicaRouter:
+    def __init__(self, urls, strategy='round_robin', retry_seconds=30,
+                 read_your_writes_seconds=5, pool_options=None, pins=None):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError(f'Unknown replica strategy: {strategy}')
+        self.urls = list(urls)
+        self.strategy = strategy
+        self.retry_seconds = retry_seconds
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self.pool_options = pool_options or {}
+        self._engines = None
+        self._down_until = {}
+        if pins is None:
+            store = MemoryStore()
+            pins = lambda: store
+        self.pins = pins
+        self._counter = itertools.count()
+
+    @property
+    def engines(self):
+        # engines are created on first use, never at import time
+        if self._engines is None:
+            engines = []
+            for url in self.urls:
+                options = {} if url.startswith('sqlite') else self.pool_options
+                engine = create_engine(url, pool_pre_ping=True, **options)
+                event.listen(engine, 'handle_error', self._on_error)
+                engines.append(engine)
+            self._engines = engines
+        return self._engines
+
+    def choose(self):
+        now = time.monotonic()
+        healthy = [engine for engine in self.engines
+                   if self._down_until.get(engine.url, 0) <= now]
+        if not healthy:
+            return None
+        if self.strategy == 'least_connections':
+            return min(healthy, key=checked_out)
+        return healthy[next(self._counter) % len(healthy)]
+
+    def mark_down(self, engine):
+        self._down_until[engine.url] = time.monotonic() + self.retry_seconds
+
+    def note_write(self, subject):
+        # the store expires the pin, so the table never outgrows its slots
+        if subject:
+            self.pins().put('pin:' + subject, b'1', self.read_your_writes_seconds)
+
+    def wrote_recently(self, subject):
+        return bool(subject) and self.pins().get('pin:' + subject) is not None
+
+    def dispose(self):
+        for engine in self._engines or ():
+            engine.dispose()
+
+    def _on_error(self, context):
+        engine = context.engine
+        if engine is not None:
+            self.mark_down(engine)
+        if has_app_context():
+            g.replica_failed = True
+
+
+def checked_out(engine):
+    # pools that keep no connections (NullPool, e.g. SQLite files) count none
+    counter = getattr(engine.pool, 'checkedout', None)
+    return counter() if counter is not None else 0
+
+
+'''
+init_replicas(app, db)
+    builds the app's ReplicaRouter from SQLALCHEMY_REPLICA_URIS and pins the
+    writer of every committed transaction to the primary
+    replica pools are sized like the primary's (DB_POOL_SIZE, DB_MAX_OVERFLOW)
+'''
+def init_replicas(app, db):
+    urls = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    if not urls:
+        return
+    app.extensions['replicas'] = ReplicaRouter(
+        urls,
+        strategy=app.config.get('REPLICA_STRATEGY', 'round_robin'),
+        retry_seconds=app.config.get('REPLICA_RETRY_SECONDS', 30),
+        read_your_writes_seconds=app.config.get('READ_YOUR_WRITES_SECONDS', 5),
+        pool_options=pool_options(app.config),
+        pins=cache_store)
+
+    if not event.contains(db.session, 'after_commit', _pin_writer):
+        event.listen(db.session, 'after_commit', _pin_writer)
+
+
+def _pin_writer(session):
+    router = session.app.extensions.get('replicas')
+    if router is not None and has_app_context() and 'current_user' in g:
+        router.note_write(g.current_user.get('sub'))
+
+
+def replica_engine():
+    '''Returns the replica engine chosen for the current request, if any.'''
+    if has_app_context():
+        return g.get('replica_engine')
+    return None
+
+
+'''
+@read_only decorator
+    routes the ORM queries of a read route to a replica
+    it must sit below @requires_auth so it receives the decoded payload
+    the primary is used when no replica is configured or healthy, when the
+    client asks for it with "X-Consistency: primary", and when the subject
+    wrote recently; a request that hits a failing replica is replayed on the
+    primary
+'''
+def read_only(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        router = current_app.extensions.get('replicas')
+        if (router is None or
+                request.headers.get('X-Consistency') == 'primary' or
+                router.wrote_recently(payload.get('sub'))):
+            return f(payload, *args, **kwargs)
+
+        g.replica_engine = router.choose()
+        try:
+            response = f(payload, *args, **kwargs)
+        except SQLAlchemyError:
+            if not g.get('replica_failed'):
+                raise
+        finally:
+            g.replica_engine = None
+
+        if g.pop('replica_failed', False):
+            current_app.extensions['sqlalchemy'].db.session.rollback()
+            response = f(payload, *args, **kwargs)
+        return response
+
+    return wrapper
@@ -0,0 +1,164 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+'''
+Shared caches
+
+Small expiring entries (verified token payloads, the JWKS key set) that
+every worker of one host can read. Keys are hashed to 32 bytes, so a raw
+bearer token is never stored. Two stores share one interface:
+
+    get(key) -> bytes or None
+    put(key, value, ttl) -> bool
+
+MemoryStore keeps entries in this process; SharedStore keeps them in a
+memory-mapped file that every worker maps, so one worker's fetch or
+verification is a hit for all of them.
+'''
+def digest(key):
+    return hashlib.sha256(key.encode('utf-8') if isinstance(key, str) else key).digest()
+
+
+class MemoryStore:
+    def __init__(self, max_entries=10000, clock=time.time):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = {}
+
+    def get(self, key):
+        entry = self._entries.get(digest(key))
+        if entry is None or entry[0] <= self.clock():
+            return None
+        return entry[1]
+
+    def put(self, key, value, ttl):
+        now = self.clock()
+        if len(self._entries) >= self.max_entries:
+            self._forget_expired(now)
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+        self._entries[digest(key)] = (now + ttl, bytes(value))
+        return True
+
+    def _forget_expired(self, now):
+        for key, (expires_at, _) in list(self._entries.items()):
+            if expires_at <= now:
+                self._entries.pop(key, None)
+
+
+'''
+SharedStore
+    a direct-mapped hash table in a memory-mapped file (by default under
+    /dev/shm, i.e. RAM): slots slots of slot_size bytes, each holding one
+    entry; a new key evicts whatever shared its slot
+    reads take no lock: every slot carries a version that a writer makes odd
+    while it writes, and a read that saw an odd or changed version counts
+    as a miss
+    writes lock only their own slot (fcntl byte-range lock), so workers
+    never wait on each other except for the same slot
+    values larger than a slot are not cached
+    the entries are trusted (verified tokens, signing keys) and the file sits
+    in a world-writable directory, so it is opened without following links
+    and refused unless this user owns it and no one else can read or write it
+    other workers may have the file mapped, so an existing file is never
+    truncated or reinitialised: one laid out for other settings is refused
+    (shared_store() puts the layout in the file name, so that only happens
+    to a foreign or damaged file)
+'''
+MAGIC = b'CASTSHM1'
+FILE_HEADER = struct.Struct('<8sII')
+SLOT_HEADER = struct.Struct('<Id32sI')
+VERSION = struct.Struct('<I')
+
+
+class SharedStore:
+    def __init__(self, path, slots=4096, slot_size=2048, clock=time.time):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        size = FILE_HEADER.size + slots * slot_size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        status = os.fstat(self._fd)
+        if status.st_uid != os.geteuid() or status.st_mode & 0o077:
+            os.close(self._fd)
+            raise PermissionError(f'{path} must be owned by this user with mode 0600')
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                # a new file: its creator lays it out while holding the lock
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, FILE_HEADER.pack(MAGIC, slots, slot_size), 0)
+            header = os.pread(self._fd, FILE_HEADER.size, 0)
+            laid_out = (len(header) == FILE_HEADER.size and
+                        FILE_HEADER.unpack(header) == (MAGIC, slots, slot_size) and
+                        os.fstat(self._fd).st_size == size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        if not laid_out:
+            os.close(self._fd)
+            raise ValueError(f'{path} is not a shared cache of {slots} slots of {slot_size} bytes')
+        self._map = mmap.mmap(self._fd, size)
+
+    def _slot(self, key_digest):
+        index = int.from_bytes(key_digest[:8], 'little') % self.slots
+        return FILE_HEADER.size + index * self.slot_size
+
+    def get(self, key):
+        key_digest = digest(key)
+        offset = self._slot(key_digest)
+        (version,) = VERSION.unpack_from(self._map, offset)
+        if version & 1:
+            return None
+        _, expires_at, slot_key, length = SLOT_HEADER.unpack_from(self._map, offset)
+        if slot_key != key_digest or expires_at <= self.clock():
+            return None
+        start = offset + SLOT_HEADER.size
+        value = self._map[start:start + length]
+        if VERSION.unpack_from(self._map, offset)[0] != version:
+            return None
+        return value
+
+    def put(self, key, value, ttl):
+        if SLOT_HEADER.size + len(value) > self.slot_size:
+            return False
+        key_digest = digest(key)
+        offset = self._slot(key_digest)
+        # the thread lock covers this process, lockf the other workers
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset, os.SEEK_SET)
+            try:
+                (version,) = VERSION.unpack_from(self._map, offset)
+                VERSION.pack_into(self._map, offset, version | 1)
+                start = offset + SLOT_HEADER.size
+                self._map[start:start + len(value)] = value
+                SLOT_HEADER.pack_into(self._map, offset, version | 1,
+                                      self.clock() + ttl, key_digest, len(value))
+                VERSION.pack_into(self._map, offset, (version | 1) + 1)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset, os.SEEK_SET)
+        return True
+
+
+'''
+shared_store(config)
+    the store named by SHARED_CACHE_PATH, or a MemoryStore when it is unset
+    the layout is appended to the file name, so changing SHARED_CACHE_SLOTS
+    or SHARED_CACHE_SLOT_SIZE starts a new file instead of clashing with one
+    that workers of the previous settings may still have mapped
+'''
+def shared_store(config):
+    path = config.get('SHARED_CACHE_PATH')
+    if not path:
+        return MemoryStore()
+    slots = config.get('SHARED_CACHE_SLOTS', 4096)
+    slot_size = config.get('SHARED_CACHE_SLOT_SIZE', 2048)
+    return SharedStore(f'{path}.{slots}x{slot_size}', slots=slots, slot_size=slot_size)
@@ -0,0 +1,70 @@
+import os
+import threading
+import weakref
+
+
+'''
+SingleFlight
+    collapses concurrent calls that share a key into one execution
+    the first caller (the leader) runs the function, every caller that
+    arrives while it is running waits and receives the same result or
+    exception
+    forget_all() makes later callers start a fresh execution, e.g. after a
+    commit that the running one may not have seen
+    a forked child starts with a fresh lock and no flights, since the
+    threads running the parent's flights do not exist in it
+'''
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        _instances.add(self)
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def forget_all(self):
+        with self._lock:
+            self._calls.clear()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_instances = weakref.WeakSet()
+
+def _reset_after_fork():
+    for flight in list(_instances):
+        flight._after_fork()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,218 @@
+import json
+import mmap
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+'''
+Columnar catalog snapshot
+
+A snapshot file holds the actors and movies tables column by column so that
+analytics jobs can memory-map it and scan it without parsing:
+
+    b'CASTCOL1' | header length (uint32 LE) | JSON header | column buffers
+
+Every buffer is little-endian and starts on an 8-byte boundary; the header
+lists its dtype, offset and length. Column kinds:
+    int64 / int32   one fixed-width value per row, NULL stored as -1
+    dict            int32 codes into the "dictionary" list of the header
+    utf8            int64 offsets (rows + 1) into a UTF-8 data buffer, plus a
+                    validity bitmap (bit i of byte i // 8 set when row i is
+                    not NULL) so NULL and '' stay apart
+'''
+MAGIC = b'CASTCOL1'
+NULL = -1
+
+SCHEMA = {
+    'actors': [
+        ('id', 'int64'),
+        ('name', 'utf8'),
+        ('age', 'int32'),
+        ('gender', 'dict'),
+        ('movie_id', 'int64'),
+    ],
+    'movies': [
+        ('id', 'int64'),
+        ('title', 'dict'),
+        ('release_date', 'utf8'),
+    ],
+}
+
+TYPECODES = {'int64': 'q', 'int32': 'i'}
+NUMPY_DTYPES = {'int64': '<i8', 'int32': '<i4'}
+
+
+def _little_endian(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _encode_column(kind, values):
+    '''Returns the header entry (minus offsets) and the buffers of one column.'''
+    if kind in TYPECODES:
+        data = array(TYPECODES[kind], (NULL if v is None else v for v in values))
+        return {'type': kind}, [('values', _little_endian(data))]
+
+    if kind == 'dict':
+        dictionary = {}
+        codes = array('i', (NULL if v is None else dictionary.setdefault(v, len(dictionary))
+                            for v in values))
+        return ({'type': kind, 'dictionary': list(dictionary)},
+                [('codes', _little_endian(codes))])
+
+    if kind == 'utf8':
+        offsets = array('q', [0])
+        data = bytearray()
+        validity = bytearray((len(values) + 7) // 8)
+        for row, value in enumerate(values):
+            if value is not None:
+                data += value.encode('utf-8')
+                validity[row // 8] |= 1 << (row % 8)
+            offsets.append(len(data))
+        return {'type': kind}, [('offsets', _little_endian(offsets)), ('data', bytes(data)),
+                                ('validity', bytes(validity))]
+
+    raise ValueError(f'Unknown column type: {kind}')
+
+
+'''
+write_snapshot(path, tables)
+    tables maps "actors"/"movies" to sequences of row mappings (e.g. the
+    .mappings() of a select on the table) and is written per SCHEMA
+'''
+def write_snapshot(path, tables):
+    header = {'version': 2, 'tables': {}}
+    buffers = []
+
+    for table, columns in SCHEMA.items():
+        rows = list(tables.get(table, ()))
+        entry = {'rows': len(rows), 'columns': {}}
+        for name, kind in columns:
+            column, column_buffers = _encode_column(kind, [row[name] for row in rows])
+            for buffer_name, payload in column_buffers:
+                column[buffer_name] = len(buffers)
+                buffers.append(payload)
+            entry['columns'][name] = column
+        header['tables'][table] = entry
+
+    # offsets depend on the header size, so settle the header first
+    header['buffers'] = [[0, len(payload)] for payload in buffers]
+    while True:
+        encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        position = _align(len(MAGIC) + 4 + len(encoded))
+        layout = []
+        for payload in buffers:
+            layout.append([position, len(payload)])
+            position = _align(position + len(payload))
+        if layout == header['buffers']:
+            break
+        header['buffers'] = layout
+
+    with open(path, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(len(encoded).to_bytes(4, 'little'))
+        snapshot.write(encoded)
+        for (offset, length), payload in zip(layout, buffers):
+            snapshot.write(b'\0' * (offset - snapshot.tell()))
+            snapshot.write(payload)
+
+
+def _align(position):
+    return (position + 7) & ~7
+
+
+'''
+Snapshot columns as returned by load_snapshot()
+'''
+class DictColumn:
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        code = self.codes[row]
+        return None if code == NULL else self.dictionary[code]
+
+
+class StringColumn:
+    def __init__(self, offsets, data, validity=None):
+        self.offsets = offsets
+        self.data = data
+        self.validity = validity
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if self.is_null(row):
+            return None
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return bytes(self.data[start:end]).decode('utf-8')
+
+    def is_null(self, row):
+        # version 1 snapshots have no bitmap: their NULLs read back as ''
+        if self.validity is None:
+            return False
+        if row < 0:
+            row += len(self)
+        return not self.validity[row // 8] >> (row % 8) & 1
+
+
+'''
+load_snapshot(path)
+    memory-maps a snapshot and returns {table: {column: values}}
+    numeric columns and dictionary codes are zero-copy NumPy arrays when
+    NumPy is installed, and memoryviews otherwise
+    the mapping stays open for as long as a returned column is alive
+'''
+def load_snapshot(path):
+    with open(path, 'rb') as snapshot:
+        mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a catalog snapshot')
+    header_length = int.from_bytes(mapped[len(MAGIC):len(MAGIC) + 4], 'little')
+    start = len(MAGIC) + 4
+    header = json.loads(mapped[start:start + header_length].decode('utf-8'))
+    layout = header['buffers']
+
+    def buffer(index, dtype=None):
+        offset, length = layout[index]
+        if dtype is None:
+            return memoryview(mapped)[offset:offset + length]
+        if numpy is not None:
+            return numpy.frombuffer(mapped, dtype=NUMPY_DTYPES[dtype],
+                                    count=length // numpy.dtype(NUMPY_DTYPES[dtype]).itemsize,
+                                    offset=offset)
+        if sys.byteorder != 'little':
+            values = array(TYPECODES[dtype], mapped[offset:offset + length])
+            values.byteswap()
+            return values
+        return memoryview(mapped)[offset:offset + length].cast(TYPECODES[dtype])
+
+    tables = {}
+    for table, entry in header['tables'].items():
+        columns = {}
+        for name, column in entry['columns'].items():
+            kind = column['type']
+            if kind in TYPECODES:
+                columns[name] = buffer(column['values'], kind)
+            elif kind == 'dict':
+                columns[name] = DictColumn(buffer(column['codes'], 'int32'), column['dictionary'])
+            elif kind == 'utf8':
+                validity = column.get('validity')
+                columns[name] = StringColumn(buffer(column['offsets'], 'int64'),
+                                             buffer(column['data']),
+                                             None if validity is None else buffer(validity))
+        tables[table] = columns
+    return tables
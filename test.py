@@ -1,10 +1,28 @@
 import os
+import gzip
+import shutil
+import sqlite3
 import unittest
 import json
+import tempfile
+import threading
+import time
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
 
-from app import create_app
-from models import setup_db, Movie, Actor
+from flask import g
+from jose import jwt
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from app import create_app, list_queries, shared_list
+from auth import AuthError
+from models import setup_db, db, db_drop_and_create_all, read_model_revision, movie_documents, castings, Movie, Actor
+from health import ReadinessProbe
+from singleflight import SingleFlight
+from profiling import StackSampler
+from snapshot import load_snapshot, write_snapshot
+from sharedcache import SharedStore, shared_store
 
 from dotenv import load_dotenv
 
@@ -34,8 +52,8 @@ class CastingTestCase(unittest.TestCase):
         with self.app.app_context():
             self.db = SQLAlchemy()
             self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+            # create and seed all tables
+            db_drop_and_create_all()
 
             self.movie = {
             'title': 'The Blacklist',
@@ -58,6 +76,92 @@ class CastingTestCase(unittest.TestCase):
     TODO
     Write at least one test for each test for successful operation and for expected errors.
     """
+    def test_create_app_uses_test_config(self):
+        app = create_app({'EXCITED': False})
+        res = app.test_client().get('/')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, b'Hello')
+
+    def test_429_client_over_rate_limit(self):
+        client = create_app({'RATELIMIT_IP': (1.0, 2)}).test_client()
+        statuses = [client.get('/health').status_code for _ in range(3)]
+        res = client.get('/health')
+        data = json.loads(res.data)
+
+        self.assertEqual(statuses[:2], [200, 200])
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertTrue(res.headers['Retry-After'])
+
+    def test_probes_are_not_rate_limited(self):
+        client = create_app({'RATELIMIT_IP': (1.0, 1)}).test_client()
+        limited = [client.get('/health').status_code for _ in range(2)]
+        probes = [client.get('/health/live').status_code for _ in range(3)]
+
+        self.assertEqual(limited, [200, 429])
+        self.assertEqual(probes, [200, 200, 200])
+
+    def test_forged_subject_does_not_drain_bucket(self):
+        app = create_app({'RATELIMIT_IP': None, 'RATELIMIT_SUBJECT': (1.0, 1),
+                          'TOKEN_CACHE_TTL': 0})
+        client = app.test_client()
+        # unsigned as far as the app is concerned, but claiming the victim's sub
+        token = jwt.encode({'sub': 'victim'}, 'not-the-key', algorithm='HS256')
+        headers = {'Authorization': 'Bearer ' + token}
+        forged = AuthError({'code': 'invalid_header', 'description': 'Forged.'}, 401)
+        with mock.patch('auth.verify_decode_jwt', side_effect=forged):
+            statuses = [client.get('/actors', headers=headers).status_code for _ in range(3)]
+        with mock.patch('auth.verify_decode_jwt', return_value={
+                'sub': 'victim', 'permissions': ['get:actors']}):
+            res = client.get('/actors', headers=headers)
+
+        self.assertEqual(statuses, [401, 401, 401])
+        self.assertEqual(res.status_code, 200)
+
+    def test_proxy_fix_limits_forwarded_client(self):
+        client = create_app({'RATELIMIT_IP': (1.0, 1), 'PROXY_FIX_HOPS': 1}).test_client()
+        first = client.get('/health', headers={'X-Forwarded-For': '203.0.113.1'})
+        second = client.get('/health', headers={'X-Forwarded-For': '203.0.113.2'})
+        again = client.get('/health', headers={'X-Forwarded-For': '203.0.113.1'})
+
+        self.assertEqual([first.status_code, second.status_code, again.status_code],
+                         [200, 200, 429])
+
+    def test_pool_is_sized_from_config(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql://localhost/casting',
+                          'DB_POOL_SIZE': 4, 'DB_MAX_OVERFLOW': 2})
+
+        self.assertEqual(app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+                         {'pool_size': 4, 'max_overflow': 2})
+
+    def test_health_live(self):
+        res = self.client().get('/health/live')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['status'], 'alive')
+
+    def test_health_ready_reports_checks(self):
+        with mock.patch('app.key_set', return_value=StubKeySet(age=0)):
+            res = self.client().get('/health/ready')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['ready'])
+        self.assertTrue(data['checks']['database']['ok'])
+        self.assertTrue(data['checks']['jwks']['ok'])
+
+    def test_503_health_ready_without_jwks(self):
+        with mock.patch('app.key_set', return_value=StubKeySet(error=OSError('down'))):
+            res = self.client().get('/health/ready')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['ready'])
+        self.assertTrue(data['checks']['database']['ok'])
+        self.assertEqual(data['checks']['jwks'], {'ok': False, 'error': 'OSError', 'age': None})
+
     def test_retrieve_movies(self):
         res = self.client().get(
             "/movies",
@@ -70,6 +174,106 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(data["movies"])
 
+    def test_retrieve_movies_from_primary(self):
+        res = self.client().get(
+            "/movies",
+            headers={
+                'Authorization': 'Bearer '+producer,
+                'X-Consistency': 'primary'
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["movies"])
+
+    def test_movie_cast_follows_actor_writes(self):
+        self.client().post('/actors', json={
+                'name': 'Cast Member', 'age': 30, 'gender': 'Female', 'movie_id': 1
+            }, headers={
+                'Authorization': 'Bearer '+producer
+            })
+        res = self.client().get(
+            "/movies",
+            headers={
+                'Authorization': 'Bearer '+producer
+            }
+        )
+        data = json.loads(res.data)
+        movie = [movie for movie in data["movies"] if movie["id"] == 1][0]
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Cast Member', [actor['name'] for actor in movie['actors']])
+
+    def test_retrieve_movies_gzip(self):
+        app = create_app({'COMPRESS_MIN_SIZE': 0})
+        headers = {'Authorization': 'Bearer '+producer}
+        plain = app.test_client().get("/movies", headers=headers)
+        res = app.test_client().get(
+            "/movies",
+            headers=dict(headers, **{'Accept-Encoding': 'gzip'})
+        )
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(res.data)), json.loads(plain.data))
+
+    def test_retrieve_movie_actors(self):
+        res = self.client().get(
+            "/movies/1/actors",
+            headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["movie_id"], 1)
+        self.assertTrue(data["actors"])
+
+    def test_retrieve_actor_movies(self):
+        res = self.client().get(
+            "/actors/1/movies",
+            headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["movies"][0]["id"], 1)
+        self.assertNotIn("actors", data["movies"][0])
+
+    def test_404_retrieve_movie_actors(self):
+        res = self.client().get(
+            "/movies/1000/actors",
+            headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data["success"])
+
+    def test_changes_follow_writes(self):
+        res = self.client().get(
+            "/changes",
+            headers={
+                'Authorization': 'Bearer '+producer
+            })
+        since = json.loads(res.data)["last_seq"]
+        self.client().patch(
+            "/actors/1",
+            json={'name': 'renamed'},
+            headers={
+                'Authorization': 'Bearer '+producer
+            })
+        res = self.client().get(
+            "/changes?since=%d" % since,
+            headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        changed = {(change["entity"], change["id"]): change for change in data["changes"]}
+        self.assertEqual(changed[("actor", 1)]["data"]["name"], 'renamed')
+        self.assertIn(("movie", 1), changed)
+        self.assertEqual(data["last_seq"], data["changes"][-1]["seq"])
+
     def test_retrieve_actors(self):
         res = self.client().get(
             "/actors",
@@ -190,6 +394,78 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(data["movies"])
 
+    def test_bulk_update_actors(self):
+        res = self.client().patch('/actors?movie_id=1', json={'gender': 'Male'}, headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['updated'], len(data['ids']))
+
+    def test_400_bulk_delete_actors_without_selection(self):
+        res = self.client().delete('/actors', headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_400_bulk_update_actors_bad_filter(self):
+        res = self.client().patch('/actors?movie_id=abc', json={'gender': 'Male'}, headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_bulk_delete_movies_releases_actors(self):
+        res = self.client().delete('/movies?ids=1', headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['ids'], [1])
+
+        res = self.client().get('/actors', headers={
+                'Authorization': 'Bearer '+producer
+            })
+        actors = json.loads(res.data)['actors']
+        self.assertTrue(all(actor['movie_id'] is None for actor in actors))
+
+    def test_404_bulk_delete_movies(self):
+        res = self.client().delete('/movies?ids=1000,1001', headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_400_create_actor_invalid_body(self):
+        res = self.client().post('/actors', json={
+                'name': 'John Wick', 'age': 'old', 'gender': 'Male', 'movie_id': 1000
+            }, headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['errors'], {'age': 'must be an integer'})
+
+    def test_400_create_actor_unknown_movie(self):
+        res = self.client().post('/actors', json={
+                'name': 'John Wick', 'age': 44, 'gender': 'Male', 'movie_id': 1000
+            }, headers={
+                'Authorization': 'Bearer '+producer
+            })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['errors'], {'movie_id': '1000 does not exist'})
+
     def test_401_create_movie_unauthorized(self):
         res = self.client().post('/movies', json=self.movie, headers='')
         data = json.loads(res.data)
@@ -233,6 +509,687 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
 
 
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """Reads go to a replica SQLite file unless they must see the primary"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        primary = os.path.join(self.directory, 'primary.db')
+        replica = os.path.join(self.directory, 'replica.db')
+        self.replica = replica
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + primary,
+            'SQLALCHEMY_REPLICA_URIS': ['sqlite:///' + replica],
+            'RATELIMIT_ENABLED': False,
+            'TOKEN_CACHE_TTL': 0,
+        })
+        with self.app.app_context():
+            db_drop_and_create_all()
+
+        # the replica lags: it still has the seed actor under its old name
+        shutil.copy(primary, replica)
+        with sqlite3.connect(replica) as connection:
+            connection.execute("UPDATE actors SET name = 'replica actor'")
+
+        self.auth = mock.patch('auth.verify_decode_jwt', return_value={
+            'sub': 'replica-tester',
+            'permissions': ['get:actors', 'post:actors']})
+        self.auth.start()
+        self.headers = {'Authorization': 'Bearer token'}
+
+    def tearDown(self):
+        self.auth.stop()
+        self.app.extensions['replicas'].dispose()
+        shutil.rmtree(self.directory)
+
+    def actor_names(self, headers=None):
+        res = self.app.test_client().get('/actors', headers=headers or self.headers)
+        self.assertEqual(res.status_code, 200)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.actor_names(), ['replica actor'])
+
+    def test_least_connections_without_pool_counts(self):
+        # SQLite file engines use NullPool, which counts no connections
+        self.app.extensions['replicas'].strategy = 'least_connections'
+        self.assertEqual(self.actor_names(), ['replica actor'])
+
+    def test_primary_on_request(self):
+        headers = dict(self.headers, **{'X-Consistency': 'primary'})
+        self.assertEqual(self.actor_names(headers), ['actor1'])
+
+    def test_writer_reads_own_writes(self):
+        res = self.app.test_client().post('/actors', json={
+                'name': 'new actor', 'age': 30, 'gender': 'Female', 'movie_id': 1
+            }, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.actor_names(), ['actor1', 'new actor'])
+
+    def test_writes_pin_reads_on_every_worker(self):
+        # two workers of one host share their pins through the shared cache
+        config = dict(self.app.config,
+                      SHARED_CACHE_PATH=os.path.join(self.directory, 'shared.cache'))
+        writer, reader = create_app(config), create_app(config)
+        try:
+            res = writer.test_client().post('/actors', json={
+                    'name': 'new actor', 'age': 30, 'gender': 'Female', 'movie_id': 1
+                }, headers=self.headers)
+            names = reader.test_client().get('/actors', headers=self.headers)
+        finally:
+            writer.extensions['replicas'].dispose()
+            reader.extensions['replicas'].dispose()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in json.loads(names.data)['actors']],
+                         ['actor1', 'new actor'])
+
+    def test_followers_of_failed_replica_flight_replay(self):
+        engine = self.app.extensions['replicas'].engines[0]
+        with self.app.test_request_context():
+            g.replica_engine = engine
+            with mock.patch.object(list_queries, 'do', side_effect=OperationalError('SELECT', {}, None)):
+                self.assertRaises(OperationalError, shared_list, 'actors', list)
+            self.assertTrue(g.replica_failed)
+
+    def test_failed_replica_is_replayed_on_primary(self):
+        with sqlite3.connect(self.replica) as connection:
+            connection.execute('DROP TABLE actors')
+
+        self.assertEqual(self.actor_names(), ['actor1'])
+        # the replica is skipped until its retry time has passed
+        self.assertEqual(self.actor_names(), ['actor1'])
+        self.assertIsNone(self.app.extensions['replicas'].choose())
+
+
+class BulkSelectionTestCase(unittest.TestCase):
+    """Bulk requests only select rows by ids given as JSON integers"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.directory, 'bulk.db'),
+            'RATELIMIT_ENABLED': False,
+            'TOKEN_CACHE_TTL': 0,
+        })
+        with self.app.app_context():
+            db_drop_and_create_all()
+            db.session.remove()
+        self.auth = mock.patch('auth.verify_decode_jwt', return_value={
+            'sub': 'bulk-tester', 'permissions': ['delete:actors', 'patch:actors']})
+        self.auth.start()
+        self.headers = {'Authorization': 'Bearer token'}
+
+    def tearDown(self):
+        self.auth.stop()
+        shutil.rmtree(self.directory)
+
+    def delete_actors(self, body):
+        return self.app.test_client().delete('/actors', json=body, headers=self.headers)
+
+    def actor_ids(self):
+        with self.app.app_context():
+            ids = [actor.id for actor in Actor.query.all()]
+            db.session.remove()
+        return ids
+
+    def test_400_string_ids(self):
+        res = self.delete_actors({'ids': '12'})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.actor_ids(), [1])
+
+    def test_400_float_and_boolean_ids(self):
+        res = self.delete_actors({'ids': [True, 1.9]})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.actor_ids(), [1])
+
+    def test_400_array_body(self):
+        deleted = self.delete_actors([1])
+        updated = self.app.test_client().patch('/actors', json=[1], headers=self.headers)
+
+        self.assertEqual(deleted.status_code, 400)
+        self.assertEqual(updated.status_code, 400)
+        self.assertEqual(self.actor_ids(), [1])
+
+    def test_integer_ids_select_rows(self):
+        res = self.delete_actors({'ids': [1]})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['ids'], [1])
+        self.assertEqual(self.actor_ids(), [])
+
+
+class MovieListCompressionTestCase(unittest.TestCase):
+    """The cached GET /movies body follows each app's compression settings"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.auth = mock.patch('auth.verify_decode_jwt', return_value={
+            'sub': 'compression-tester', 'permissions': ['get:movies']})
+        self.auth.start()
+        self.headers = {'Authorization': 'Bearer token', 'Accept-Encoding': 'gzip'}
+
+    def tearDown(self):
+        self.auth.stop()
+        shutil.rmtree(self.directory)
+
+    def get_movies(self, name, **config):
+        app = create_app(dict({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.directory, name),
+            'RATELIMIT_ENABLED': False,
+            'TOKEN_CACHE_TTL': 0,
+        }, **config))
+        with app.app_context():
+            db_drop_and_create_all()
+            db.session.remove()
+        return app.test_client().get('/movies', headers=self.headers)
+
+    def test_settings_are_per_app(self):
+        small = self.get_movies('small.db', COMPRESS_MIN_SIZE=0)
+        large = self.get_movies('large.db', COMPRESS_MIN_SIZE=10 ** 6)
+
+        self.assertEqual(small.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(small.data))['movies'][0]['id'], 1)
+        self.assertNotIn('Content-Encoding', large.headers)
+        self.assertIn('Accept-Encoding', large.headers['Vary'])
+
+    def test_streamed_responses_are_sent_plain(self):
+        app = create_app({'COMPRESS_MIN_SIZE': 0})
+        app.add_url_rule('/stream', 'stream', lambda: app.response_class(
+            ('{"n":%d}\n' % n for n in range(1000)), mimetype='application/x-ndjson'))
+        res = app.test_client().get('/stream', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(len(res.data.splitlines()), 1000)
+
+    def test_disabled_compression_serves_plain_body(self):
+        res = self.get_movies('plain.db', COMPRESS_ENABLED=False, COMPRESS_MIN_SIZE=0)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(json.loads(res.data)['movies'][0]['id'], 1)
+
+
+class MovieCastTestCase(unittest.TestCase):
+    """Actors and their references follow a movie being uncast or deleted"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.directory, 'cast.db'),
+            'RATELIMIT_ENABLED': False,
+            'TOKEN_CACHE_TTL': 0,
+            'REFERENCE_REFRESH_SECONDS': 3600,
+        })
+        with self.app.app_context():
+            db_drop_and_create_all()
+            db.session.remove()
+        self.auth = mock.patch('auth.verify_decode_jwt', return_value={
+            'sub': 'cast-tester', 'permissions': ['delete:movies', 'patch:movies', 'post:actors']})
+        self.auth.start()
+        self.headers = {'Authorization': 'Bearer token'}
+
+    def tearDown(self):
+        self.auth.stop()
+        shutil.rmtree(self.directory)
+
+    def actor_movie_id(self):
+        with self.app.app_context():
+            movie_id = Actor.query.get(1).movie_id
+            db.session.remove()
+        return movie_id
+
+    def test_delete_movie_releases_actors(self):
+        res = self.app.test_client().delete('/movies/1', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(self.actor_movie_id())
+
+    def test_bulk_deleted_movie_cannot_be_referenced(self):
+        client = self.app.test_client()
+        actor = {'name': 'Julia', 'age': 34, 'gender': 'Female', 'movie_id': 1}
+        created = client.post('/actors', json=actor, headers=self.headers)
+        deleted = client.delete('/movies?ids=1', headers=self.headers)
+        res = client.post('/actors', json=actor, headers=self.headers)
+
+        self.assertEqual(created.status_code, 200)
+        self.assertEqual(deleted.status_code, 200)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['errors'], {'movie_id': '1 does not exist'})
+
+    def test_movie_created_by_another_worker_is_found(self):
+        other = create_app(dict(self.app.config))
+        actor = {'name': 'Julia', 'age': 34, 'gender': 'Female', 'movie_id': 2}
+        missing = self.app.test_client().post('/actors', json=actor, headers=self.headers)
+        with mock.patch('auth.verify_decode_jwt', return_value={
+                'sub': 'cast-tester', 'permissions': ['post:movies']}):
+            other.test_client().post('/movies', json={'title': 'Movie2', 'release_date': 'May'},
+                                     headers=self.headers)
+        res = self.app.test_client().post('/actors', json=actor, headers=self.headers)
+
+        self.assertEqual(missing.status_code, 400)
+        self.assertEqual(res.status_code, 200)
+
+    def test_uncast_actor_clears_movie_id(self):
+        res = self.app.test_client().delete('/movies/1/actors/1', headers=self.headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movie']['actors'], [])
+        self.assertIsNone(self.actor_movie_id())
+
+
+class ChangeWaitersTestCase(unittest.TestCase):
+    """Streams and waiting long-polls are capped per worker"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.directory, 'changes.db'),
+            'RATELIMIT_ENABLED': False,
+            'TOKEN_CACHE_TTL': 0,
+            'CHANGES_MAX_WAITERS': 1,
+            'CHANGES_STREAM_SECONDS': 0,
+        })
+        with self.app.app_context():
+            db_drop_and_create_all()
+            db.session.remove()
+        self.auth = mock.patch('auth.verify_decode_jwt', return_value={
+            'sub': 'changes-tester', 'permissions': ['get:movies']})
+        self.auth.start()
+        self.headers = {'Authorization': 'Bearer token'}
+        self.feed = self.app.extensions['changes']
+
+    def tearDown(self):
+        self.auth.stop()
+        shutil.rmtree(self.directory)
+
+    def test_503_when_every_waiter_is_taken(self):
+        client = self.app.test_client()
+        self.assertTrue(self.feed.hold())
+        try:
+            waiting = client.get('/changes?since=1000&wait=1', headers=self.headers)
+            stream = client.get('/changes', headers=dict(self.headers, Accept='text/event-stream'))
+            immediate = client.get('/changes?since=1000', headers=self.headers)
+        finally:
+            self.feed.release()
+
+        self.assertEqual(waiting.status_code, 503)
+        self.assertEqual(waiting.headers['Retry-After'], '10')
+        self.assertEqual(stream.status_code, 503)
+        self.assertEqual(immediate.status_code, 200)
+
+    def test_400_non_finite_wait(self):
+        client = self.app.test_client()
+        statuses = [client.get(f'/changes?wait={wait}', headers=self.headers).status_code
+                    for wait in ('nan', 'inf', '-inf')]
+
+        self.assertEqual(statuses, [400, 400, 400])
+        self.assertTrue(self.feed.hold())
+        self.feed.release()
+
+    def test_finished_requests_give_their_waiter_back(self):
+        client = self.app.test_client()
+        poll = client.get('/changes?since=1000&wait=0.01', headers=self.headers)
+        stream = client.get('/changes', headers=dict(self.headers, Accept='text/event-stream'))
+        stream.close()
+
+        self.assertEqual(poll.status_code, 200)
+        self.assertEqual(stream.status_code, 200)
+        self.assertTrue(self.feed.hold())
+        self.feed.release()
+
+
+class UpgradeTestCase(unittest.TestCase):
+    """A database with only the first release's tables can be upgraded"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'baseline.db')
+        with sqlite3.connect(path) as connection:
+            connection.executescript('''
+                CREATE TABLE movies (id INTEGER PRIMARY KEY, title VARCHAR, release_date VARCHAR);
+                CREATE TABLE actors (id INTEGER PRIMARY KEY, name VARCHAR, age INTEGER,
+                                     gender VARCHAR, movie_id INTEGER REFERENCES movies (id));
+                INSERT INTO movies VALUES (1, 'Movie1', 'July');
+                INSERT INTO actors VALUES (1, 'actor1', 25, 'Female', 1);
+            ''')
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+            'RATELIMIT_ENABLED': False,
+            'TOKEN_CACHE_TTL': 0,
+        })
+        self.auth = mock.patch('auth.verify_decode_jwt', return_value={
+            'sub': 'upgrade-tester', 'permissions': ['get:movies', 'post:movies']})
+        self.auth.start()
+        self.headers = {'Authorization': 'Bearer token'}
+
+    def tearDown(self):
+        self.auth.stop()
+        shutil.rmtree(self.directory)
+
+    def test_rebuild_read_model_creates_missing_tables(self):
+        result = self.app.test_cli_runner().invoke(args=['rebuild-read-model'])
+
+        self.assertIsNone(result.exception)
+
+    def test_migrate_castings_upgrades_baseline(self):
+        result = self.app.test_cli_runner().invoke(args=['migrate-castings'])
+        client = self.app.test_client()
+        movies = client.get('/movies', headers=self.headers)
+        created = client.post('/movies', json={'title': 'Movie2', 'release_date': 'May'},
+                              headers=self.headers)
+
+        self.assertIsNone(result.exception)
+        self.assertEqual(json.loads(movies.data)['movies'][0]['actors'][0]['name'], 'actor1')
+        self.assertEqual(created.status_code, 200)
+
+
+class ReadModelTestCase(unittest.TestCase):
+    """The read model revision labels every list the app caches"""
+
+    def test_reseed_moves_revision_forward(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'app.db')})
+            with app.app_context():
+                db_drop_and_create_all()
+                before = read_model_revision()
+                db_drop_and_create_all()
+                self.assertGreater(read_model_revision(), before)
+                db.session.remove()
+
+    def test_actor_cast_after_its_flush_is_rerendered(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'app.db')})
+            with app.app_context():
+                db_drop_and_create_all()
+                Movie(title='Movie2', release_date='May').insert()
+                actor = Actor.query.get(1)
+                actor.name = 'Renamed'
+                db.session.flush()
+                # another writer casts the actor between our flush and our
+                # commit; plain SQL, so nothing marks movie 2 stale here
+                db.session.execute(castings.insert().values(movie_id=2, actor_id=1))
+                db.session.commit()
+
+                documents = [json.loads(document) for document in movie_documents()]
+                self.assertEqual([[actor['name'] for actor in movie['actors']]
+                                  for movie in documents], [['Renamed'], ['Renamed']])
+                db.session.remove()
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """Concurrent identical calls share one execution"""
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def query():
+            calls.append(1)
+            time.sleep(0.1)
+            return ['movie']
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do('movies', query)))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['movie']] * 10)
+
+    def test_errors_reach_every_caller(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        followers = 5
+        arrived = threading.Barrier(followers + 1)
+        leader_error = ValueError('db down')
+        calls = []
+        errors = []
+
+        def query():
+            calls.append(1)
+            started.set()
+            release.wait()
+            raise leader_error
+
+        def call():
+            try:
+                flight.do('movies', query)
+            except ValueError as error:
+                errors.append(error)
+
+        def follow():
+            arrived.wait()
+            call()
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        threads = [threading.Thread(target=follow) for _ in range(followers)]
+        for thread in threads:
+            thread.start()
+        arrived.wait()
+        # give the followers time to join the flight the leader still holds
+        time.sleep(0.2)
+        release.set()
+        for thread in [leader] + threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(errors), followers + 1)
+        self.assertTrue(all(error is leader_error for error in errors))
+
+
+class StubKeySet:
+    ttl = 600
+
+    def __init__(self, age=None, error=None, release=None):
+        self._age = age
+        self.error = error
+        self.release = release
+
+    def age(self):
+        return self._age
+
+    def get(self):
+        if self.release is not None:
+            self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return {'keys': []}
+
+
+class ReadinessProbeTestCase(unittest.TestCase):
+    """Each dependency is checked on its own and bounded by the timeout"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine(
+            'sqlite:///' + os.path.join(self.directory, 'probe.db'), poolclass=QueuePool,
+            pool_size=1, max_overflow=1, connect_args={'check_same_thread': False})
+        self.release = threading.Event()
+
+    def tearDown(self):
+        # let the hung checks finish so their helper threads exit
+        self.release.set()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def hang(self, *args, **kwargs):
+        self.release.wait()
+        raise OperationalError('SELECT 1', {}, Exception('gone'))
+
+    def test_ready_when_every_dependency_answers(self):
+        probe = ReadinessProbe(self.engine, StubKeySet(), timeout=1)
+        ready, checks = probe.check()
+
+        self.assertTrue(ready)
+        self.assertTrue(checks['database']['ok'])
+        self.assertTrue(checks['jwks']['ok'])
+
+    def test_hung_database_does_not_block_jwks(self):
+        probe = ReadinessProbe(self.engine, StubKeySet(), timeout=0.2)
+        with mock.patch.object(self.engine, 'connect', side_effect=self.hang):
+            ready, checks = probe.check()
+
+        self.assertFalse(ready)
+        self.assertEqual(checks['database'], {'ok': False, 'error': 'timed out after 0.2s'})
+        self.assertTrue(checks['jwks']['ok'])
+
+    def test_hung_check_is_not_started_twice(self):
+        probe = ReadinessProbe(self.engine, StubKeySet(), cache_seconds=0, timeout=0.1)
+        with mock.patch.object(self.engine, 'connect', side_effect=self.hang) as connect:
+            probe.check()
+            ready, checks = probe.check()
+
+        self.assertFalse(ready)
+        self.assertFalse(checks['database']['ok'])
+        self.assertEqual(connect.call_count, 1)
+
+    def test_failing_jwks_names_the_error(self):
+        probe = ReadinessProbe(self.engine, StubKeySet(error=OSError('down')), timeout=1)
+        ready, checks = probe.check()
+
+        self.assertFalse(ready)
+        self.assertTrue(checks['database']['ok'])
+        self.assertEqual(checks['jwks'], {'ok': False, 'error': 'OSError', 'age': None})
+
+    def test_pool_saturation_uses_configured_overflow(self):
+        probe = ReadinessProbe(self.engine, StubKeySet(age=0), max_saturation=0.5,
+                               max_overflow=1)
+        with self.engine.connect():
+            ready, checks = probe.check()
+
+        self.assertFalse(ready)
+        self.assertEqual(checks['pool']['capacity'], 2)
+        self.assertEqual(checks['pool']['saturation'], 0.5)
+
+
+class StackSamplerTestCase(unittest.TestCase):
+    """Sampled stacks are collapsed and counted per request label"""
+
+    def test_samples_registered_threads_only(self):
+        sampler = StackSampler(interval=0.001)
+
+        def slow_request():
+            sampler.start('GET /movies')
+            # stay registered until the sampler has caught this frame
+            deadline = time.monotonic() + 10
+            while not sampler.stacks()[0] and time.monotonic() < deadline:
+                time.sleep(0.001)
+            sampler.stop()
+
+        thread = threading.Thread(target=slow_request)
+        thread.start()
+        thread.join()
+        sampler.join(timeout=10)
+
+        stacks, requests = sampler.stacks(reset=True)
+        self.assertEqual(requests, {'GET /movies': 1})
+        self.assertTrue(stacks)
+        for stack in stacks:
+            self.assertTrue(stack.startswith('GET /movies;'))
+            self.assertIn('test.py:slow_request', stack)
+        self.assertEqual(sampler.stacks(), ({}, {}))
+
+    def test_non_ascii_profile_header_is_not_an_error(self):
+        app = create_app({'PROFILE_ENABLED': True, 'PROFILE_TOKEN': 'secret'})
+        res = app.test_client().get('/health/live', headers={'X-Profile': 's\u00e9cret'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(app.extensions['profiler'].stacks(), ({}, {}))
+
+
+class SharedStoreTestCase(unittest.TestCase):
+    """Entries written by one worker are read by the others"""
+
+    def test_entries_are_shared_and_expire(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shared.cache')
+            writer = SharedStore(path, slots=16, slot_size=256)
+            reader = SharedStore(path, slots=16, slot_size=256)
+
+            self.assertTrue(writer.put('jwks', b'{"keys": []}', 60))
+            self.assertEqual(reader.get('jwks'), b'{"keys": []}')
+            self.assertIsNone(reader.get('missing'))
+
+            writer.put('expired', b'old', -1)
+            self.assertIsNone(reader.get('expired'))
+            self.assertFalse(writer.put('large', b'x' * 256, 60))
+
+    def test_mapped_file_is_never_relaid_out(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shared.cache')
+            store = SharedStore(path, slots=16, slot_size=256)
+            store.put('jwks', b'{"keys": []}', 60)
+
+            with self.assertRaises(ValueError):
+                SharedStore(path, slots=8, slot_size=256)
+            self.assertEqual(os.path.getsize(path), store._map.size())
+            self.assertEqual(store.get('jwks'), b'{"keys": []}')
+
+    def test_file_others_can_reach_is_refused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shared.cache')
+            planted = os.path.join(directory, 'planted.cache')
+            SharedStore(planted, slots=16, slot_size=256)
+            os.chmod(planted, 0o666)
+            os.symlink(os.path.join(directory, 'elsewhere'), path)
+
+            with self.assertRaises(PermissionError):
+                SharedStore(planted, slots=16, slot_size=256)
+            with self.assertRaises(OSError):
+                SharedStore(path, slots=16, slot_size=256)
+            self.assertFalse(os.path.exists(os.path.join(directory, 'elsewhere')))
+
+    def test_layout_is_part_of_the_file_name(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shared.cache')
+            small = shared_store({'SHARED_CACHE_PATH': path, 'SHARED_CACHE_SLOTS': 8,
+                                  'SHARED_CACHE_SLOT_SIZE': 256})
+            large = shared_store({'SHARED_CACHE_PATH': path, 'SHARED_CACHE_SLOTS': 16,
+                                  'SHARED_CACHE_SLOT_SIZE': 256})
+
+            self.assertEqual(small.path, path + '.8x256')
+            self.assertEqual(large.path, path + '.16x256')
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """Columnar snapshots read back what was written"""
+
+    def test_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), 'catalog.col')
+        write_snapshot(path, {
+            'actors': [
+                {'id': 1, 'name': 'John', 'age': 44, 'gender': 'Male', 'movie_id': 1},
+                {'id': 2, 'name': 'Julia', 'age': None, 'gender': 'Female', 'movie_id': None},
+            ],
+            'movies': [
+                {'id': 1, 'title': 'The Blacklist', 'release_date': 'Jan'},
+                {'id': 2, 'title': 'Untitled', 'release_date': None},
+                {'id': 3, 'title': 'Untitled', 'release_date': ''},
+            ],
+        })
+        tables = load_snapshot(path)
+
+        self.assertEqual(list(tables['actors']['id']), [1, 2])
+        self.assertEqual(list(tables['actors']['age']), [44, -1])
+        self.assertEqual(list(tables['actors']['movie_id']), [1, -1])
+        self.assertEqual(tables['actors']['gender'][1], 'Female')
+        self.assertEqual(tables['actors']['name'][0], 'John')
+        self.assertEqual(tables['movies']['title'][0], 'The Blacklist')
+        self.assertEqual([tables['movies']['release_date'][row] for row in range(3)],
+                         ['Jan', None, ''])
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
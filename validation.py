@@ -0,0 +1,214 @@
+import time
+from flask import current_app
+from sqlalchemy import event, select
+from models import db, Movie
+from singleflight import SingleFlight
+
+
+TYPE_NAMES = {str: 'string', int: 'integer', float: 'number', bool: 'boolean', list: 'list'}
+
+
+class ValidationError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+
+
+'''
+Field
+    declares one body field: its JSON type, whether POST requires it, and
+    optional bounds; ref names a reference set (see init_validation) that
+    an id must belong to
+'''
+class Field:
+    def __init__(self, type, required=False, min=None, max=None,
+                 min_length=None, max_length=None, ref=None):
+        self.type = type
+        self.required = required
+        self.min = min
+        self.max = max
+        self.min_length = min_length
+        self.max_length = max_length
+        self.ref = ref
+
+    def compile(self):
+        '''Returns check(value) -> error message or None.'''
+        tests = []
+        if self.type is int:
+            # bool is an int subclass, but true is not an age
+            tests.append(lambda value: None if type(value) is int else 'must be an integer')
+        else:
+            kind, name = self.type, TYPE_NAMES.get(self.type, self.type.__name__)
+            tests.append(lambda value: None if isinstance(value, kind) else f'must be a {name}')
+        if self.min is not None:
+            low = self.min
+            tests.append(lambda value: None if value >= low else f'must be at least {low}')
+        if self.max is not None:
+            high = self.max
+            tests.append(lambda value: None if value <= high else f'must be at most {high}')
+        if self.min_length is not None:
+            shortest = self.min_length
+            tests.append(lambda value: None if len(value.strip()) >= shortest else 'must not be empty')
+        if self.max_length is not None:
+            longest = self.max_length
+            tests.append(lambda value: None if len(value) <= longest else f'must be at most {longest} characters')
+
+        def check(value):
+            for test in tests:
+                error = test(value)
+                if error is not None:
+                    return error
+        return check
+
+
+'''
+compile_schema(fields, partial)
+    builds a validator for a body schema once, so a request only runs the
+    prepared checks: validate(body) returns the values of the declared
+    fields that were given, or raises ValidationError with one message per
+    bad field; partial (PATCH) schemas require nothing
+    fields given as null count as not given and unknown fields are ignored,
+    as the routes always did
+    reference checks run last, only on otherwise valid values, so bad input
+    never reaches the database
+'''
+def compile_schema(fields, partial=False):
+    checks = [(name, field.required and not partial, field.compile())
+              for name, field in fields.items()]
+    refs = [(name, field.ref) for name, field in fields.items() if field.ref is not None]
+
+    def validate(body):
+        if not isinstance(body, dict):
+            raise ValidationError({'body': 'must be a JSON object'})
+        values, errors = {}, {}
+        for name, required, check in checks:
+            value = body.get(name)
+            if value is None:
+                if required:
+                    errors[name] = 'is required'
+                continue
+            error = check(value)
+            if error is None:
+                values[name] = value
+            else:
+                errors[name] = error
+        if not errors:
+            for name, ref in refs:
+                if name in values and values[name] not in reference_set(ref):
+                    errors[name] = f'{values[name]} does not exist'
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+    return validate
+
+
+MOVIE = {
+    'title': Field(str, required=True, min_length=1),
+    'release_date': Field(str, required=True, min_length=1),
+}
+
+ACTOR = {
+    'name': Field(str, required=True, min_length=1),
+    # no upper age policy, only what the integer column can hold
+    'age': Field(int, required=True, min=0, max=2**31 - 1),
+    'gender': Field(str, required=True, min_length=1),
+    'movie_id': Field(int, required=True, min=1, ref='movies'),
+}
+
+CASTING = {
+    'actor_id': Field(int, required=True, min=1),
+}
+
+validate_movie = compile_schema(MOVIE)
+validate_movie_patch = compile_schema(MOVIE, partial=True)
+validate_actor = compile_schema(ACTOR)
+validate_actor_patch = compile_schema(ACTOR, partial=True)
+validate_casting = compile_schema(CASTING)
+
+
+'''
+IdSet
+    the ids of one table, loaded on first use and kept in memory
+    a hit costs no query; a miss reloads the ids (at most once every
+    min_refresh seconds, concurrent misses sharing one load) and a miss
+    between reloads looks the one id up with exists(id), so a row another
+    worker just created is always found
+    commits in this process add and remove their own rows directly; a row
+    deleted by another worker may still be listed, in which case the
+    database's foreign key has the final say
+'''
+class IdSet:
+    def __init__(self, load, exists, min_refresh=1.0):
+        self.load = load
+        self.exists = exists
+        self.min_refresh = min_refresh
+        self._ids = None
+        self._loaded_at = 0.0
+        self._loads = SingleFlight()
+
+    def __contains__(self, id):
+        ids = self._ids
+        if ids is not None and id in ids:
+            return True
+        if ids is None or time.monotonic() - self._loaded_at >= self.min_refresh:
+            return id in self._loads.do('ids', self._load)
+        if self.exists(id):
+            self.update(added=[id])
+            return True
+        return False
+
+    def _load(self):
+        ids = frozenset(self.load())
+        self._ids, self._loaded_at = ids, time.monotonic()
+        return ids
+
+    def update(self, added=(), removed=()):
+        # swapped as a whole, so readers never see a set being changed
+        if self._ids is not None:
+            self._ids = (self._ids | frozenset(added)) - frozenset(removed)
+
+
+def load_movie_ids():
+    return db.session.execute(select(Movie.id)).scalars().all()
+
+def movie_exists(id):
+    return db.session.execute(select(Movie.id).where(Movie.id == id)).first() is not None
+
+
+'''
+init_validation(app)
+    gives the app the reference sets the schemas check ids against
+'''
+def init_validation(app):
+    app.extensions['references'] = {
+        'movies': IdSet(load_movie_ids, movie_exists,
+                        app.config.get('REFERENCE_REFRESH_SECONDS', 1.0)),
+    }
+    for name, listener in (('after_flush', track_movie_ids),
+                           ('after_commit', apply_movie_ids),
+                           ('after_rollback', forget_movie_ids)):
+        if not event.contains(db.session, name, listener):
+            event.listen(db.session, name, listener)
+
+
+def reference_set(name):
+    return current_app.extensions['references'][name]
+
+
+# Movie.after_bulk records the ids of bulk deletes in the same delta
+def track_movie_ids(session, flush_context):
+    added = [obj.id for obj in session.new if isinstance(obj, Movie)]
+    removed = [obj.id for obj in session.deleted if isinstance(obj, Movie)]
+    if added or removed:
+        delta = session.info.setdefault('movie_ids', (set(), set()))
+        delta[0].update(added)
+        delta[1].update(removed)
+
+def apply_movie_ids(session):
+    delta = session.info.pop('movie_ids', None)
+    references = current_app.extensions.get('references') if delta else None
+    if references is not None:
+        references['movies'].update(*delta)
+
+def forget_movie_ids(session):
+    session.info.pop('movie_ids', None)